@@ -1,4 +1,6 @@
 import os
+import functools
+import numpy as np
 
 dummy_val = -9.0 #value used for missing variables, e.g. sublead_lepton_pt when there is only one lepton
 
@@ -44,6 +46,35 @@ all_columns_no_weight = list(filter(lambda x: "weight" not in x, all_columns))
 weights_systematics = list(filter(lambda x: "weight" in x, all_columns))
 weights_systematics.remove("weight_central")
 
+#dtypes columns are stored with after preprocessing
+#any other float column (kinematics, weights, MX, MY...) is stored as float32 and any other integer column as uint8
+column_dtypes = {
+  "lead_lepton_id": "int8",
+  "sublead_lepton_id": "int8",
+  "lead_lepton_charge": "int8",
+  "sublead_lepton_charge": "int8",
+  "LeadPhoton_pixelSeed": "uint8",
+  "SubleadPhoton_pixelSeed": "uint8",
+  "process_id": "uint8",
+  "category": "uint8",
+  "year": "uint16", #2016UL_pre and 2016UL_pos are both stored as 2016
+  "event": "uint64"
+}
+
+def columnDtype(column, kind):
+  """
+  Storage dtype for a column whose input dtype is of the given kind (numpy dtype.kind, e.g. "f" or "i").
+  Returns None for columns that should be left as they are.
+  """
+  if column in column_dtypes:
+    return column_dtypes[column]
+  elif kind == "f":
+    return "float32"
+  elif kind in ["i", "u"]:
+    return "uint8"
+  else:
+    return None
+
 # train_features = {
 #   'base': ['Diphoton_eta', 'Diphoton_phi', 'Diphoton_helicity', 'Diphoton_pt_mgg', 'Diphoton_max_mvaID', 'Diphoton_min_mvaID', 'Diphoton_dPhi', 'LeadPhoton_pt_mgg', 'LeadPhoton_eta', 'LeadPhoton_phi', 'LeadPhoton_mass', 'LeadPhoton_mvaID', 'SubleadPhoton_pt_mgg', 'SubleadPhoton_eta', 'SubleadPhoton_phi', 'SubleadPhoton_mass', 'SubleadPhoton_mvaID', 'n_electrons', 'n_muons', 'n_taus', 'n_iso_tracks', 'n_jets', 'n_bjets', 'MET_pt', 'MET_phi', 'diphoton_met_dPhi', 'lead_lepton_met_dphi', 'ditau_dphi', 'ditau_deta', 'ditau_dR', 'ditau_mass', 'ditau_pt', 'ditau_eta', 'lead_lepton_pt', 'lead_lepton_eta', 'lead_lepton_phi', 'lead_lepton_mass', 'lead_lepton_charge', 'lead_lepton_id', 'sublead_lepton_pt', 'sublead_lepton_eta', 'sublead_lepton_phi', 'sublead_lepton_mass', 'sublead_lepton_charge', 'sublead_lepton_id', 'category', 'jet_1_pt', 'jet_1_eta', 'jet_1_btagDeepFlavB', 'jet_2_pt', 'jet_2_eta', 'jet_2_btagDeepFlavB', 'b_jet_1_btagDeepFlavB', 'dilep_leadpho_mass', 'dilep_subleadpho_mass', 'year', 'LeadPhoton_genPartFlav', 'SubleadPhoton_genPartFlav'],
 #   'additional': ['reco_MggtauMET_mgg', 'reco_MX', 'reco_MX_MET', 'Diphoton_deta', 'Diphoton_ditau_deta', 'LeadPhoton_lead_lepton_dR', 'Diphoton_lead_lepton_dR', 'LeadPhoton_sublead_lepton_dR', 'Diphoton_sublead_lepton_deta', 'Diphoton_sublead_lepton_dphi', 'Diphoton_lead_lepton_deta', 'SubleadPhoton_lead_lepton_dR', 'Diphoton_lead_lepton_dphi', 'LeadPhoton_ditau_dR', 'SubleadPhoton_ditau_dR', 'SubleadPhoton_sublead_lepton_dR', 'sublead_lepton_met_dPhi', 'ditau_met_dPhi', 'Diphoton_dR', 'Diphoton_sublead_lepton_dR', 'ditau_phi', 'Diphoton_ditau_dphi', 'Diphoton_ditau_dR']
@@ -80,18 +111,55 @@ def get_MX_MY(sig_proc):
     raise Exception("Unexpected signal process: %s"%sig_proc)
   return MX, MY
 
-def add_MX_MY(df, proc_dict):
-  #get sig_procs in parquet file
-  sig_procs_in = [sig_proc for sig_proc in sig_procs["all"] if sig_proc in proc_dict.keys()]
+@functools.lru_cache()
+def buildProcessTable(proc_items):
+  proc_dict = dict(proc_items)
+  n = max(proc_dict.values())+1 if len(proc_dict) > 0 else 0
+  bkg_groups = [group for group in bkg_procs.keys() if group != "all"]
+
+  table = {
+    "name": np.full(n, "", dtype=object),
+    "MX": np.full(n, dummy_val),
+    "MY": np.full(n, dummy_val),
+    "is_signal": np.zeros(n, dtype=bool),
+    "bkg_group": np.full(n, -1, dtype=np.int64),
+    "bkg_groups": tuple(bkg_groups)
+  }
+  for proc, i in proc_dict.items():
+    table["name"][i] = proc
+    if proc in sig_procs["all"]:
+      table["MX"][i], table["MY"][i] = get_MX_MY(proc)
+      table["is_signal"][i] = True
+    for j, group in enumerate(bkg_groups):
+      if proc in bkg_procs[group]: table["bkg_group"][i] = j
+
+  #the same table is returned to every caller so it must not be modified
+  for key in ["name", "MX", "MY", "is_signal", "bkg_group"]:
+    table[key].setflags(write=False)
+  return table
+
+def processTable(proc_dict):
+  """
+  Per process_id arrays built from a summary json's sample_id_map (cached):
+    name, MX and MY (dummy_val if not signal), is_signal and bkg_group (index into table["bkg_groups"], -1 if not background)
+  so that a per-event quantity is table[key][process_id]. The arrays are shared between callers and read-only.
+  """
+  return buildProcessTable(tuple(sorted(proc_dict.items())))
+
+def processLookup(values, process_id, default):
+  """values[process_id] with default for process ids that are not in the table"""
+  process_id = np.asarray(process_id)
+  if len(values) == 0:
+    return np.full(process_id.shape, default)
+  if (len(process_id) > 0) and (process_id.max() >= len(values)):
+    return np.where(process_id < len(values), values[np.minimum(process_id, len(values)-1)], default)
+  return values[process_id]
 
-  df["MX"] = dummy_val
-  df["MY"] = dummy_val
-  
-  for sig_proc in sig_procs_in:
-    MX, MY = get_MX_MY(sig_proc)
-    
-    df.loc[df.process_id==proc_dict[sig_proc], "MX"] = MX
-    df.loc[df.process_id==proc_dict[sig_proc], "MY"] = MY
+def add_MX_MY(df, proc_dict):
+  table = processTable(proc_dict)
+  process_id = df.process_id.to_numpy()
+  df["MX"] = processLookup(table["MX"], process_id, dummy_val)
+  df["MY"] = processLookup(table["MY"], process_id, dummy_val)
 
 def parserToList(args):
   names = list(filter(lambda x: x[0] != "_", dir(args)))
@@ -100,7 +168,7 @@ def parserToList(args):
   for name in names:
     value = getattr(args, name)
     if type(value) == list:
-      if len(value) > 0: l.append("--%s %s"%(name.replace("_", "-"), " ".join(value)))
+      if len(value) > 0: l.append("--%s %s"%(name.replace("_", "-"), " ".join([str(x) for x in value])))
     elif value is True:
       l.append("--%s"%name.replace("_", "-"))
     elif type(value) in [str, float, int]:
@@ -0,0 +1,89 @@
+"""
+Stratified subsample tiers of a processed parquet file for fast development runs.
+
+A tier with fraction f of merged_nominal.parquet is written to merged_nominal_tier<f>.parquet
+(see parquet_loader.tierPath). It holds round(f*n) randomly chosen events (at least one) of every
+process_id, where n is the number of events of that process, and every weight column is scaled
+by n/round(f*n) so that the yields of each process are unchanged on average. The file is written
+one record batch at a time, so a tier costs one pass over the full file and every later load only
+reads the tier, e.g. parquet_loader.readDataFrame(path, tier=0.01).
+
+Usage: python dataset_tiers.py -i merged_nominal.parquet --fractions 0.01 0.1
+"""
+
+import argparse
+import json
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import parquet_loader
+import event_index
+
+def sampleBatch(process_ids, remaining, needed, rng):
+  """
+  Rows of a batch to keep so that, over all batches, needed[p] rows are drawn uniformly from the
+  remaining[p] rows of each process p. The number kept from a batch is hypergeometric, which needs
+  only the number of events of each process and not their positions. remaining and needed are updated in place.
+  """
+  keep = np.zeros(len(process_ids), dtype=bool)
+  for process_id in np.unique(process_ids):
+    p = int(process_id)
+    rows = np.flatnonzero(process_ids == process_id)
+    k = rng.hypergeometric(needed[p], remaining[p]-needed[p], len(rows)) if needed[p] > 0 else 0
+    keep[rng.choice(rows, k, replace=False)] = True
+    remaining[p] -= len(rows)
+    needed[p] -= k
+  return keep
+
+def isWeight(field):
+  return ("weight" in field.name) and pa.types.is_floating(field.type)
+
+def writeTier(path, fraction, seed=1, batch_size=100000):
+  """Write the tier of path with the given fraction of events, selecting and scaling the events in one pass"""
+  rng = np.random.default_rng(seed)
+  dataset = parquet_loader.openDataset(path, use_cache=False)
+
+  #only the number of events of each process is needed beforehand, which does not depend on the order rows are read in
+  process_ids = parquet_loader.readTable(path, columns=["process_id"], use_cache=False).column("process_id").to_numpy()
+  ids, counts = np.unique(process_ids, return_counts=True)
+  n_selected = np.maximum(1, np.round(fraction*counts).astype(np.int64))
+  scales = counts / n_selected
+  remaining = {int(p): int(n) for p, n in zip(ids, counts)}
+  needed = {int(p): int(n) for p, n in zip(ids, n_selected)}
+
+  info = {"source": path, "fraction": fraction, "seed": seed}
+  metadata = dict(dataset.schema.metadata or {})
+  metadata[b"dataset_tier"] = json.dumps(info).encode()
+  schema = dataset.schema.with_metadata(metadata)
+
+  tier_path = parquet_loader.tierPath(path, fraction)
+  writer = pq.ParquetWriter(tier_path, schema)
+  for batch in dataset.to_batches(batch_size=batch_size):
+    batch_ids = batch.column(batch.schema.get_field_index("process_id")).to_numpy()
+    keep = sampleBatch(batch_ids, remaining, needed, rng)
+    if not keep.any(): continue
+
+    batch = batch.filter(pa.array(keep))
+    scale = pa.array(scales[np.searchsorted(ids, batch_ids[keep])])
+    columns = [pc.multiply(column, scale.cast(field.type)) if isWeight(field) else column for field, column in zip(schema, batch.columns)]
+    writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+  writer.close()
+  assert (sum(remaining.values()) == 0) and (sum(needed.values()) == 0)
+
+  event_index.writeIndex(tier_path)
+  print(">> Written %s (%d/%d events)"%(tier_path, n_selected.sum(), len(process_ids)))
+  return tier_path
+
+def writeTiers(path, fractions, seed=1, batch_size=100000):
+  return [writeTier(path, fraction, seed, batch_size) for fraction in fractions]
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--parquet-input', '-i', type=str, required=True)
+  parser.add_argument('--fractions', type=float, nargs="+", default=[0.01, 0.1])
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--batch-size', type=int, default=100000, help="Number of rows read from the input at a time.")
+  args = parser.parse_args()
+
+  writeTiers(args.parquet_input, args.fractions, args.seed, args.batch_size)
@@ -0,0 +1,107 @@
+"""
+Sorted event-key index stored next to a processed parquet file (or partitioned dataset).
+
+Every event is identified by a single uint64 key packing (year, process_id, event). The index
+holds the keys in sorted order with the row of the file each key came from, so that nominal and
+varied files can be aligned with a merge of two sorted arrays instead of building pandas
+MultiIndexes. Indexes are written by the preprocessing and merging scripts, or on first use,
+and are rebuilt automatically if the parquet file has changed since.
+"""
+
+import os
+import numpy as np
+import pyarrow as pa
+import parquet_loader
+
+#bits used for each part of the key, year | process_id | event
+year_bits = 11
+process_id_bits = 12
+event_bits = 64 - year_bits - process_id_bits
+
+def eventKeys(year, process_id, event):
+  """Pack year, process_id and event number arrays into uint64 keys"""
+  year = np.asarray(year).astype(np.uint64)
+  process_id = np.asarray(process_id).astype(np.uint64)
+  event = np.asarray(event).astype(np.uint64)
+  for name, values, bits in [("year", year, year_bits), ("process_id", process_id, process_id_bits), ("event", event, event_bits)]:
+    if (len(values) > 0) and (values.max() >= 2**bits):
+      raise ValueError("%s does not fit in the %d bits reserved for it in the event key"%(name, bits))
+  return (year << np.uint64(process_id_bits + event_bits)) | (process_id << np.uint64(event_bits)) | event
+
+def keyProcessIds(keys):
+  """process_id packed in each key"""
+  return (np.asarray(keys, dtype=np.uint64) >> np.uint64(event_bits)) & np.uint64(2**process_id_bits - 1)
+
+def indexPath(path):
+  if parquet_loader.isPartitioned(path):
+    return os.path.join(path, "_event_index.npz")
+  return path + ".event_index.npz"
+
+def sourceStamp(path):
+  """Size and modification time identifying the version of the file the index was built from"""
+  if parquet_loader.isPartitioned(path):
+    path = os.path.join(path, parquet_loader.partitioning_file)
+  stat = os.stat(path)
+  return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+def buildIndex(path):
+  """Returns (keys, rows): the sorted event keys of a file and the row each came from. Only year, process_id and event are read."""
+  table = parquet_loader.readTable(path, columns=["year", "process_id", "event"], use_cache=False) #read once, not worth caching
+  keys = eventKeys(*[table.column(column).to_numpy() for column in ["year", "process_id", "event"]])
+  rows = np.argsort(keys, kind="stable") #duplicated keys stay in row order
+  return keys[rows], rows
+
+def writeIndex(path):
+  keys, rows = buildIndex(path)
+  tmp_path = indexPath(path) + ".tmp.npz"
+  np.savez(tmp_path, keys=keys, rows=rows, source=sourceStamp(path))
+  os.replace(tmp_path, indexPath(path))
+  return keys, rows
+
+def loadIndex(path):
+  """(keys, rows) for a file, building and saving the index if it is missing or out of date"""
+  if os.path.exists(indexPath(path)):
+    with np.load(indexPath(path)) as index:
+      if (index["source"] == sourceStamp(path)).all():
+        return index["keys"], index["rows"]
+  return writeIndex(path)
+
+def firstOccurrence(keys, rows):
+  """Drop duplicated keys, keeping the first row each appears in"""
+  unique = np.ones(len(keys), dtype=bool)
+  unique[1:] = keys[1:] != keys[:-1]
+  return keys[unique], rows[unique]
+
+def intersectSorted(a, b):
+  """
+  Keys common to the sorted, unique arrays a and b, and their positions in a and b.
+  A stable sort of two concatenated sorted runs is a single linear merge (timsort).
+  """
+  both = np.concatenate([a, b])
+  order = np.argsort(both, kind="stable")
+  merged = both[order]
+  match = merged[1:] == merged[:-1] #each array is unique so an equal pair has one element from each, a's first
+  return merged[:-1][match], order[:-1][match], order[1:][match] - len(a)
+
+def join(paths):
+  """
+  Align events across files, e.g. the nominal and the up and down variations of a systematic.
+  Returns (keys, rows) where rows[i][j] is the row in paths[i] of the event with key keys[j].
+  Only events present in every file are kept and duplicated keys use their first occurrence.
+  """
+  keys, rows = firstOccurrence(*loadIndex(paths[0]))
+  rows = [rows]
+  for path in paths[1:]:
+    other_keys, other_rows = firstOccurrence(*loadIndex(path))
+    keys, i, j = intersectSorted(keys, other_keys)
+    rows = [each[i] for each in rows] + [other_rows[j]]
+  return keys, rows
+
+def loadAligned(paths, columns=None):
+  """Load a dataframe from each of paths containing only the common events, row j of every dataframe being the same event"""
+  keys, rows = join(paths)
+  dfs = []
+  for path, path_rows in zip(paths, rows):
+    table = parquet_loader.readTable(path, columns=columns)
+    dfs.append(table.take(pa.array(path_rows)).to_pandas().reset_index(drop=True))
+  return dfs
@@ -10,13 +10,14 @@ import numpy as np
 
 import sys
 import common
+import parquet_loader
 import json
 
-df = pd.read_parquet(sys.argv[1], columns=["process_id", "weight_central"])
 with open(sys.argv[2], "r") as f:
   proc_dict = json.load(f)["sample_id_map"]
 
 sig_ids = [proc_dict[proc] for proc in common.sig_procs["Graviton"]]
+df = parquet_loader.readDataFrame(sys.argv[1], columns=["process_id", "weight_central"], process_ids=sig_ids)
 mx = [common.get_MX_MY(proc)[0] for proc in common.sig_procs["Graviton"]]
 
 lumi = sum([common.lumi_table[year] for year in common.lumi_table.keys()])
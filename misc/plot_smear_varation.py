@@ -1,4 +1,5 @@
 import pandas as pd
+import systematic_delta
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
@@ -10,8 +11,8 @@ vars = ["LeadPhoton_pt", "SubleadPhoton_pt", "Diphoton_pt", "Diphoton_mass"]
 columns = ["weight_central", "process_id"] + vars
 
 nominal = pd.read_parquet("Inputs/merged_nominal.parquet", columns=columns)
-up = pd.read_parquet("Inputs/merged_smear_up.parquet", columns=columns)
-down = pd.read_parquet("Inputs/merged_smear_down.parquet", columns=columns)
+up = systematic_delta.loadDataFrame("Inputs/merged_smear_up.parquet", columns=columns) #full or delta encoded
+down = systematic_delta.loadDataFrame("Inputs/merged_smear_down.parquet", columns=columns)
 
 nominal = nominal[nominal.process_id==33]
 up = up[up.process_id==33]
@@ -4,6 +4,8 @@ import numpy as np
 import os
 import argparse
 import json
+import parquet_loader
+import common
 
 import matplotlib
 matplotlib.use("Agg")
@@ -16,11 +18,12 @@ lumi_table = {
 }
 
 def loadDataFrame(args):
-  df = pd.read_parquet(args.parquet_input)
   with open(args.summary_input) as f:
     proc_dict = json.load(f)['sample_id_map']
 
-  df = df[(df.Diphoton_mass>100) & (df.Diphoton_mass<180)]
+  #the other signal processes are not used
+  process_ids = [proc_id for proc, proc_id in proc_dict.items() if (proc not in common.sig_procs["all"]) or (proc == args.sig_proc)]
+  df = parquet_loader.readDataFrame(args.parquet_input, process_ids=process_ids, preselection={"mass_windows": [(100, 180)]})
 
   data = df[df.process_id == proc_dict["Data"]]
   sig = df[df.process_id == proc_dict[args.sig_proc]]
@@ -3,6 +3,8 @@ import numpy as np
 import argparse
 import os
 import json
+import common
+import parquet_loader
 
 from optimisation.limit import optimiseBoundary
 from optimisation.limit import transformScores
@@ -10,9 +12,11 @@ from optimisation.limit import transformScores
 from optimisation.limit import getBoundariesPerformance
 
 def loadDataFrame(args):
-  df = pd.read_parquet(args.parquet_input)
   with open(args.summary_input) as f:
     proc_dict = json.load(f)['sample_id_map']
+  #skip the other signal processes
+  process_ids = [proc_dict[proc] for proc in proc_dict.keys() if (proc not in common.sig_procs["all"]) or (proc == args.sig_proc)]
+  df = parquet_loader.readDataFrame(args.parquet_input, process_ids=process_ids, tier=args.dataset_tier)
 
   data = df[df.process_id == proc_dict["Data"]]
   sig = df[df.process_id == proc_dict[args.sig_proc]]
@@ -63,6 +67,7 @@ if __name__=="__main__":
   parser.add_argument('--pres', type=float, default=(100,150), nargs=2)
   parser.add_argument('--sr', type=float, default=(120,130), nargs=2)
   parser.add_argument('--score', type=str, default="score")
+  parser.add_argument('--dataset-tier', type=float, default=None, help="Read the stratified subsample tier with this fraction of events (see dataset_tiers.py) instead of the whole dataset.")
 
   parser.add_argument('--low', type=float, default=0.1)
   parser.add_argument('--high', type=float, default=0.99)
@@ -3,14 +3,20 @@ import numpy as np
 import argparse
 import os
 import json
+import parquet_loader
 
 from optimisation.limit import getBoundariesPerformance
 
 def loadDataFrame(args):
-  df = pd.read_parquet(args.parquet_input)
   with open(args.summary_input) as f:
     proc_dict = json.load(f)['sample_id_map']
 
+  #data is only needed in the sidebands, signal is needed everywhere
+  sidebands = [(args.pres[0], args.sr[0]), (args.sr[1], args.pres[1])]
+  preselection = [{"process_ids": [proc_dict["Data"]], "mass_windows": sidebands},
+                  {"process_ids": [proc_dict[sig_proc] for sig_proc in args.sig_procs]}]
+  df = parquet_loader.readDataFrame(args.parquet_input, preselection=preselection)
+
   data = df[df.process_id == proc_dict["Data"]]
   sigs = {sig_proc: df[df.process_id == proc_dict[sig_proc]] for sig_proc in args.sig_procs}
 
@@ -95,11 +101,7 @@ def getOptimResults(args, data, optimal_boundaries, optimal_limits):
   return optim_results
 
 def main(args):
-  data, sigs, proc_dict = loadDataFrame(args)
-
-  bm = data.Diphoton_mass
-  sidebands = ((bm > args.pres[0]) & (bm < args.sr[0])) | ((bm > args.sr[1]) & (bm < args.pres[1]))
-  data = data[sidebands]
+  data, sigs, proc_dict = loadDataFrame(args) #data is already restricted to the sidebands
 
   optimal_boundaries, optimal_limits = optimiseBoundaries(args, data, sigs, proc_dict)
   print(optimal_boundaries)
@@ -5,6 +5,7 @@ import argparse
 import os
 import uproot
 import common
+import parquet_loader
 
 """
 Given one set of category boundaries, for every mass point (including interpolated)
@@ -43,7 +44,7 @@ def writeOutputTree(mass, weight, process, cat_name, year, undo_lumi_scaling=Fal
     f["%s_13TeV_%s"%(process, cat_name)] = df
 
 def main(args):
-  df = pd.read_parquet(args.parquet_input)
+  df = parquet_loader.readDataFrame(args.parquet_input)
   with open(args.optim_results) as f:
     optim_results = json.load(f)
   with open(args.summary_input, "r") as f:
@@ -3,9 +3,10 @@ import numpy as np
 import json 
 import argparse
 import os
+import parquet_loader
 
 def loadDataFrame(args):
-  df = pd.read_parquet(args.parquet_input)
+  df = parquet_loader.readDataFrame(args.parquet_input)
   with open(args.optim_results) as f:
     optim_results = json.load(f)
 
@@ -0,0 +1,177 @@
+"""
+Shared loading of processed parquet files.
+
+The input can be a single parquet file or a dataset directory partitioned by year and process_id
+(written by processInputs/combine_parquet.py --partitioned), in which case
+  <directory>/year=2017/process_id=3/part-0.parquet
+holds the 2017 events of process 3. Selecting processes or years then only opens the matching files.
+For a single file the same selection is applied while reading, skipping row groups whose
+statistics rule them out.
+
+Repeated loads of the same file can skip decompression and decoding by setting the environment
+variable PARQUET_ARROW_CACHE to a directory (or calling enableCache). The first load of a file then
+converts it to an uncompressed Arrow IPC file named by a hash of its parquet footer, size, modification
+time and inode (see cachePath), and every later load memory-maps that file, so only the pages of the
+requested columns are read and processes reading the same file share them through the page cache.
+One-off reads (e.g. building an event index) pass use_cache=False so they do not write a copy. Cache
+files are never evicted: an IPC file is about the uncompressed size of its parquet file, and removing
+old ones (e.g. after a file is reprocessed) is up to the user.
+
+Rows can also be rejected during the scan with a declarative preselection (see preselectionFilter),
+e.g. {"pixel_veto": True, "mass_windows": [(100, 180)]}, so that they are never converted to pandas.
+
+Development runs can read a stratified subsample tier of a file instead (written by dataset_tiers.py)
+by passing its fraction as tier.
+"""
+
+import os
+import re
+import json
+import hashlib
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pyarrow.fs
+
+partition_columns = ["year", "process_id"]
+partitioning_file = "_partitioning.json" #files starting with _ are ignored when the dataset is read
+
+cache_dir = os.environ.get("PARQUET_ARROW_CACHE")
+
+def enableCache(directory):
+  global cache_dir
+  cache_dir = directory
+
+def isPartitioned(path):
+  return os.path.isdir(path)
+
+def writePartitioningInfo(path, schema, partitions):
+  """Record the types of the partition columns and the partitions that were written, {process_id: [directory, ...]}"""
+  info = {
+    "types": {column: str(schema.field(column).type) for column in partition_columns},
+    "partitions": {str(process_id): sorted(directories) for process_id, directories in partitions.items()}
+  }
+  with open(os.path.join(path, partitioning_file), "w") as f:
+    json.dump(info, f, indent=4)
+
+def loadPartitioningInfo(path):
+  with open(os.path.join(path, partitioning_file), "r") as f:
+    return json.load(f)
+
+def tierPath(path, fraction):
+  """Path of the subsample tier of a parquet file (or partitioned directory) with the given fraction of events"""
+  return path.split(".parquet")[0] + "_tier%g.parquet"%fraction
+
+def isTierPath(path):
+  return re.search(r"_tier[0-9.e+-]+\.parquet$", path) != None
+
+def footerBytes(path):
+  """Raw parquet footer (schema, row groups and column statistics) of a file"""
+  with open(path, "rb") as f:
+    f.seek(-8, os.SEEK_END)
+    footer_length = int.from_bytes(f.read(4), "little")
+    f.seek(-8-footer_length, os.SEEK_END)
+    return f.read(footer_length)
+
+def cachePath(path):
+  """
+  Arrow IPC cache file for a parquet file, keyed by its footer (which holds the offsets and statistics of every
+  column chunk) and its size, modification time and inode. Hashing the contents would cost a full read of the
+  file on every load; the stat fields make sure a file rewritten in place with the same footer is not served stale data.
+  """
+  stat = os.stat(path)
+  h = hashlib.sha256()
+  h.update(("%d %d %d %d"%(stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)).encode())
+  h.update(footerBytes(path))
+  return os.path.join(cache_dir, h.hexdigest() + ".arrow")
+
+def writeCache(path, cache_path):
+  """Convert a parquet file to an uncompressed Arrow IPC file one record batch at a time"""
+  os.makedirs(cache_dir, exist_ok=True)
+  tmp_path = "%s.tmp%d"%(cache_path, os.getpid()) #written under a unique name and moved into place so concurrent loads never see a partial file
+  pf = pq.ParquetFile(path)
+  with pa.OSFile(tmp_path, "wb") as sink:
+    with pa.ipc.new_file(sink, pf.schema_arrow) as writer:
+      for batch in pf.iter_batches():
+        writer.write_batch(batch)
+  os.replace(tmp_path, cache_path)
+
+def openDataset(path, use_cache=True):
+  """
+  pyarrow dataset for a parquet file or partitioned directory, with year and process_id typed as when they were written.
+  A single file is read through the Arrow IPC cache if it is enabled, unless use_cache is False.
+  """
+  if (not isPartitioned(path)) and (cache_dir != None) and use_cache:
+    cache_path = cachePath(path)
+    if not os.path.exists(cache_path):
+      writeCache(path, cache_path)
+    return ds.dataset(cache_path, format="ipc", filesystem=pyarrow.fs.LocalFileSystem(use_mmap=True))
+  elif not isPartitioned(path):
+    return ds.dataset(path, format="parquet")
+
+  types = loadPartitioningInfo(path)["types"]
+  schema = pa.schema([(column, pa.type_for_alias(types[column])) for column in partition_columns])
+  return ds.dataset(path, format="parquet", partitioning=ds.partitioning(schema, flavor="hive"))
+
+def combine(a, b, op):
+  """Combine two filter expressions where None means no selection"""
+  if a is None: return b
+  if b is None: return a
+  return op(a, b)
+
+def selection(schema, process_ids=None, years=None):
+  """Dataset filter expression selecting the given process ids and years (None means no selection)"""
+  expression = None
+  for column, values in zip(["process_id", "year"], [process_ids, years]):
+    if values == None: continue
+    value_set = pa.array([int(value) for value in values], type=schema.field(column).type)
+    expression = combine(expression, ds.field(column).isin(value_set), lambda a, b: a & b)
+  return expression
+
+def preselectionFilter(schema, preselection):
+  """
+  Dataset filter expression for a preselection given as a dict with any of the keys
+    pixel_veto: if True, keep events where neither photon has a pixel seed
+    mass_windows: list of (low, high), keep events with low < Diphoton_mass < high in any window
+    process_ids, years: keep events with these process ids and years
+  A list of dicts keeps the events passing any of them. None means no selection.
+  """
+  if preselection == None: return None
+  if isinstance(preselection, (list, tuple)):
+    expression = None
+    for each in preselection:
+      expression = combine(expression, preselectionFilter(schema, each), lambda a, b: a | b)
+    return expression
+
+  expression = selection(schema, preselection.get("process_ids"), preselection.get("years"))
+  if preselection.get("pixel_veto", False):
+    pixel_veto = (ds.field("LeadPhoton_pixelSeed") == 0) & (ds.field("SubleadPhoton_pixelSeed") == 0)
+    expression = combine(expression, pixel_veto, lambda a, b: a & b)
+  if preselection.get("mass_windows") != None:
+    windows = None
+    for low, high in preselection["mass_windows"]:
+      window = (ds.field("Diphoton_mass") > float(low)) & (ds.field("Diphoton_mass") < float(high))
+      windows = combine(windows, window, lambda a, b: a | b)
+    expression = combine(expression, windows, lambda a, b: a & b)
+  return expression
+
+def readTable(path, columns=None, process_ids=None, years=None, preselection=None, tier=None, use_cache=True):
+  if tier != None:
+    path = tierPath(path, tier)
+  dataset = openDataset(path, use_cache)
+  if columns != None:
+    columns = list(columns)
+    #keep a stored pandas index, as pd.read_parquet does
+    pandas_metadata = dataset.schema.pandas_metadata
+    if pandas_metadata != None:
+      columns += [column for column in pandas_metadata["index_columns"] if isinstance(column, str) and (column not in columns)]
+  expression = combine(selection(dataset.schema, process_ids, years), preselectionFilter(dataset.schema, preselection), lambda a, b: a & b)
+  return dataset.to_table(columns=columns, filter=expression)
+
+def readDataFrame(path, columns=None, process_ids=None, years=None, preselection=None, tier=None):
+  """
+  Equivalent to pd.read_parquet(path, columns=columns) followed by selecting the rows with
+  the given process ids and years that pass the preselection, but without reading the rows
+  that are not selected. If tier is given, the subsample tier with that fraction is read instead.
+  """
+  return readTable(path, columns, process_ids, years, preselection, tier).to_pandas()
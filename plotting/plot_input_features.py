@@ -12,6 +12,7 @@ import argparse
 import os
 
 import json
+import parquet_loader
 from collections import OrderedDict
 
 from tqdm import tqdm
@@ -275,6 +276,7 @@ if __name__=="__main__":
   parser.add_argument('--config', '-c', type=str)
   parser.add_argument('--norm', default=False, action="store_true")
   parser.add_argument('--weight', default="weight_central", type=str)
+  parser.add_argument('--dataset-tier', type=float, default=None, help="Read the stratified subsample tier with this fraction of events (see dataset_tiers.py) instead of the whole dataset.")
   args = parser.parse_args()
 
   with open(args.summary, "r") as f:
@@ -289,7 +291,7 @@ if __name__=="__main__":
   columns = common.all_columns_no_weight + [args.weight]
   columns_to_exclude = ["event", "MX", "MY"]
   columns = list(set(columns).difference(columns_to_exclude))
-  df = pd.read_parquet(args.input, columns=columns)
+  df = parquet_loader.readDataFrame(args.input, columns=columns, tier=args.dataset_tier)
   df.rename({args.weight: "weight"}, axis=1, inplace=True)
 
   print(">> Splitting into data, background and signal")
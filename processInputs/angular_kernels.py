@@ -0,0 +1,86 @@
+"""
+Angular separations (deta, dphi and dR) between many pairs of objects in one pass.
+
+The objects' eta and phi are given as contiguous float32 arrays of shape (n_objects, n_events).
+Every requested pair is computed for an event before moving on to the next, and pairs that
+do not exist for single lepton events (category 8) are set to common.dummy_val in the same loop.
+numba is used if it is installed, otherwise an equivalent numpy version that works through the events
+in chunks, writing into the preallocated outputs, so that its temporaries are bounded by the chunk size.
+"""
+
+import numpy as np
+
+try:
+  import numba
+except ImportError:
+  numba = None
+
+pi = np.float32(np.pi)
+two = np.float32(2)
+
+def dphi(x, y):
+  """Absolute difference between two angles, folded into [0, pi]"""
+  d = np.abs(x - y)
+  return d - two*(d - pi)*np.floor(d/pi)
+
+def angularSeparationsNumpy(eta, phi, pairs, masked, single_lepton, dummy_val, deta, delta_phi, dR, chunk_size=16384):
+  a, b = pairs[:,0], pairs[:,1]
+  for start in range(0, eta.shape[1], chunk_size):
+    s = slice(start, start+chunk_size)
+    e = deta[:,s]
+    np.subtract(eta[a,s], eta[b,s], out=e)
+
+    #dphi folded in place
+    d = delta_phi[:,s]
+    np.subtract(phi[a,s], phi[b,s], out=d)
+    np.abs(d, out=d)
+    d -= two*(d - pi)*np.floor(d/pi)
+
+    r = dR[:,s]
+    np.multiply(d, d, out=r)
+    r += e*e
+    np.sqrt(r, out=r)
+
+    mask = masked[:,np.newaxis] & single_lepton[np.newaxis,s]
+    for x in [e, d, r]:
+      np.copyto(x, dummy_val, where=mask)
+
+if numba != None:
+  @numba.njit(parallel=True, cache=True)
+  def angularSeparationsLoop(eta, phi, pairs, masked, single_lepton, dummy_val, deta, delta_phi, dR):
+    for k in numba.prange(eta.shape[1]):
+      for p in range(pairs.shape[0]):
+        if masked[p] and single_lepton[k]:
+          deta[p,k] = dummy_val
+          delta_phi[p,k] = dummy_val
+          dR[p,k] = dummy_val
+        else:
+          a = pairs[p,0]
+          b = pairs[p,1]
+          de = eta[a,k] - eta[b,k]
+          d = abs(phi[a,k] - phi[b,k])
+          dp = d - two*(d - pi)*np.floor(d/pi)
+          deta[p,k] = de
+          delta_phi[p,k] = dp
+          dR[p,k] = np.sqrt(dp*dp + de*de)
+
+def angularSeparations(eta, phi, pairs, masked, single_lepton, dummy_val):
+  """
+  eta, phi: float32 arrays (n_objects, n_events)
+  pairs: int array (n_pairs, 2) of indices of the objects in eta and phi
+  masked: bool array (n_pairs) of pairs to set to dummy_val when single_lepton
+  single_lepton: bool array (n_events)
+  Returns deta, dphi and dR as float32 arrays of shape (n_pairs, n_events)
+  """
+  eta = np.ascontiguousarray(eta, dtype=np.float32)
+  phi = np.ascontiguousarray(phi, dtype=np.float32)
+  pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+  masked = np.asarray(masked, dtype=bool)
+  single_lepton = np.asarray(single_lepton, dtype=bool)
+
+  outputs = [np.empty((len(pairs), eta.shape[1]), dtype=np.float32) for i in range(3)]
+  if numba == None:
+    angularSeparationsNumpy(eta, phi, pairs, masked, single_lepton, np.float32(dummy_val), *outputs)
+  else:
+    angularSeparationsLoop(eta, phi, pairs, masked, single_lepton, np.float32(dummy_val), *outputs)
+  return outputs
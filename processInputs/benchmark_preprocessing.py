@@ -0,0 +1,186 @@
+"""
+Time and memory-profile each stage of the preprocessing and merging on synthetic (or given) inputs.
+
+Writes a json report containing the git commit so that reports from different commits can be compared:
+  python processInputs/benchmark_preprocessing.py -o benchmark.json --n-events 500000
+  python processInputs/benchmark_preprocessing.py -o new.json --compare benchmark.json
+
+Memory is reported for each stage as
+  python_peak_mb: peak of the allocations made through python (numpy and pandas) during the stage, from tracemalloc
+  rss_peak_mb: peak resident memory of the process during the stage, which includes arrow's allocations
+  arrow_max_memory_mb: peak of the arrow memory pool since the start of the process, not reset between stages
+The rss peak is reset before each stage through /proc/self/clear_refs. Where that is not possible (not Linux)
+it is also the peak since the start of the process, and the report has "rss_peak_per_stage": false.
+tracemalloc adds some overhead to the timing, use --no-memory to turn it off.
+"""
+
+import argparse
+import os
+import json
+import time
+import platform
+import subprocess
+import contextlib
+import tempfile
+import shutil
+import tracemalloc
+import resource
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import common
+import derived_features
+import event_index
+import generate_synthetic_inputs
+import process_HiggsDNA_Inputs
+import combine_parquet
+
+def resetPeakRSS():
+  """Reset the peak resident memory (VmHWM) of the process to its current value. Returns False if not supported."""
+  try:
+    with open("/proc/self/clear_refs", "w") as f:
+      f.write("5")
+    return True
+  except OSError:
+    return False
+
+def peakRSS():
+  """Peak resident memory of the process in MB, since the last resetPeakRSS if it is supported"""
+  if os.path.exists("/proc/self/status"):
+    with open("/proc/self/status", "r") as f:
+      for line in f:
+        if line.startswith("VmHWM:"): return int(line.split()[1])/1024
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def gitInfo():
+  repo = os.path.dirname(os.path.abspath(common.__file__))
+  def git(*args):
+    try:
+      return subprocess.run(["git"] + list(args), cwd=repo, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+      return None
+  status = git("status", "--porcelain", "--untracked-files=no")
+  return {"commit": git("rev-parse", "HEAD"), "dirty": None if status == None else (status != "")}
+
+class Benchmark:
+  def __init__(self, track_memory=True):
+    self.track_memory = track_memory
+    self.rss_peak_per_stage = True
+    self.stages = {}
+
+  def run(self, name, function, *args, **kwargs):
+    """Run function(*args, **kwargs) as a stage, silencing its output, and return its result"""
+    if self.track_memory: tracemalloc.start() #only allocations made during the stage are traced
+    self.rss_peak_per_stage &= resetPeakRSS()
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+      result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+
+    self.stages[name] = {"time": elapsed, "rss_peak_mb": peakRSS(), "arrow_max_memory_mb": pa.default_memory_pool().max_memory()/1024**2}
+    if self.track_memory:
+      self.stages[name]["python_peak_mb"] = tracemalloc.get_traced_memory()[1]/1024**2
+      tracemalloc.stop()
+    print("%s %8.3f s %10.1f MB rss"%(name.ljust(30), elapsed, self.stages[name]["rss_peak_mb"]) + (" %10.1f MB python"%self.stages[name]["python_peak_mb"] if self.track_memory else ""))
+    return result
+
+def benchmarkStages(bench, parquet_input, summary_input, output_dir, keep_features):
+  """Each step of process_HiggsDNA_Inputs.main run separately, in the same order"""
+  with open(summary_input, "r") as f:
+    proc_dict = json.load(f)["sample_id_map"]
+
+  pf = pq.ParquetFile(parquet_input)
+  keep_columns = None if keep_features == None else process_HiggsDNA_Inputs.getKeepColumns(pf.schema_arrow.names, keep_features)
+  input_columns = process_HiggsDNA_Inputs.getInputColumns(pf.schema_arrow, keep_columns)
+
+  #the pixel veto is part of the read
+  df = bench.run("read", lambda: process_HiggsDNA_Inputs.readTable(parquet_input, input_columns).to_pandas(split_blocks=True, self_destruct=True))
+  bench.run("sanitise", process_HiggsDNA_Inputs.sanitise, df)
+  bench.run("add_MX_MY", common.add_MX_MY, df, proc_dict)
+  bench.run("addFeatures", derived_features.addFeatures, df, keep_columns)
+  bench.run("applyColumnDtypes", process_HiggsDNA_Inputs.applyColumnDtypes, df)
+  if keep_columns != None: df = df[keep_columns]
+  bench.run("write", df.to_parquet, os.path.join(output_dir, "stages.parquet"))
+
+def benchmark(args, bench, input_dir):
+  summary_input = os.path.join(input_dir, "summary.json")
+  parquet_inputs = sorted([os.path.join(input_dir, folder, f) for folder in args.folders for f in os.listdir(os.path.join(input_dir, folder))])
+  output_dir = tempfile.mkdtemp(prefix="benchmark_output_", dir=args.work_dir)
+
+  benchmarkStages(bench, parquet_inputs[0], summary_input, output_dir, args.keep_features)
+
+  outputs = []
+  for i, parquet_input in enumerate(parquet_inputs):
+    outputs.append(os.path.join(output_dir, "processed_%d.parquet"%i))
+    bench.run("main[%d]"%i, process_HiggsDNA_Inputs.main, parquet_input, outputs[-1], summary_input, False, args.keep_features)
+  if args.stream_batch_size != None:
+    bench.run("main_streaming", process_HiggsDNA_Inputs.main, parquet_inputs[0], os.path.join(output_dir, "streamed.parquet"), summary_input, False, args.keep_features, args.stream_batch_size)
+
+  bench.run("event_index", event_index.writeIndex, outputs[0])
+  bench.run("merge", combine_parquet.streamMerge, outputs, os.path.join(output_dir, "merged.parquet"))
+  bench.run("merge_partitioned", combine_parquet.streamMerge, outputs, os.path.join(output_dir, "merged_partitioned"), partitioned=True)
+
+  n_events = sum([pq.ParquetFile(path).metadata.num_rows for path in parquet_inputs])
+  if not args.keep_files: shutil.rmtree(output_dir)
+  return {"n_files": len(parquet_inputs), "n_events": n_events}
+
+def compare(report, reference):
+  print("Comparison with %s (%s)"%(reference["commit"], reference["date"]))
+  for name, stage in report["stages"].items():
+    if name not in reference["stages"]: continue
+    ratio = stage["time"] / reference["stages"][name]["time"]
+    print("%s %8.3f s -> %8.3f s (x%.2f)"%(name.ljust(30), reference["stages"][name]["time"], stage["time"], ratio))
+
+def main(args):
+  bench = Benchmark(not args.no_memory)
+
+  if args.input_dir == None:
+    input_dir = tempfile.mkdtemp(prefix="benchmark_input_", dir=args.work_dir)
+    generate_args = argparse.Namespace(output_dir=input_dir, folders=args.folders, n_files=args.n_files, n_events=args.n_events,
+                                       processes=None, years=["2016UL_pre", "2016UL_pos", "2017", "2018"], row_group_size=None, seed=args.seed)
+    bench.run("generate", generate_synthetic_inputs.main, generate_args)
+  else:
+    input_dir = args.input_dir
+
+  inputs = benchmark(args, bench, input_dir)
+  if (args.input_dir == None) and (not args.keep_files): shutil.rmtree(input_dir)
+
+  report = gitInfo()
+  report.update({
+    "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "host": platform.node(),
+    "versions": {"python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__, "pyarrow": pa.__version__},
+    "config": vars(args),
+    "inputs": inputs,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+    "rss_peak_per_stage": bench.rss_peak_per_stage,
+    "stages": bench.stages
+  })
+
+  with open(args.output, "w") as f:
+    json.dump(report, f, indent=4)
+
+  if args.compare != None:
+    with open(args.compare, "r") as f:
+      compare(report, json.load(f))
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--output', '-o', type=str, default="benchmark.json", help="Path of the json report.")
+  parser.add_argument('--input-dir', '-i', type=str, default=None, help="HiggsDNA-like input directory (summary.json and folders of parquet files). Synthetic inputs are generated if not given.")
+  parser.add_argument('--folders', type=str, nargs="+", default=["low_mass"])
+  parser.add_argument('--n-files', type=int, default=2, help="Number of synthetic files per folder.")
+  parser.add_argument('--n-events', type=int, default=200000, help="Number of events per synthetic file.")
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--keep-features', '-f', type=str, default=None)
+  parser.add_argument('--stream-batch-size', type=int, default=None, help="Also benchmark process_HiggsDNA_Inputs.main in streaming mode with this batch size.")
+  parser.add_argument('--work-dir', type=str, default=None, help="Directory for the generated inputs and outputs. Default is the system temporary directory.")
+  parser.add_argument('--keep-files', action="store_true", default=False, help="Keep the generated inputs and outputs instead of deleting them.")
+  parser.add_argument('--no-memory', action="store_true", default=False, help="Do not track memory.")
+  parser.add_argument('--compare', type=str, default=None, help="Previous report to compare the timings with.")
+  args = parser.parse_args()
+
+  main(args)
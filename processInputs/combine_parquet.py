@@ -1,7 +1,16 @@
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
+from tqdm import tqdm
 import json
 import argparse
 import os
+import preprocessing_cache
+import parquet_loader
+import event_index
+import dataset_tiers
 
 def loadSummaries(args):
   summaries = []
@@ -11,61 +20,122 @@ def loadSummaries(args):
 
   return summaries
 
-def loadDataFrames(args):
-  dfs = []
-  for parquet_path in args.parquet_input:
-    dfs.append(pd.read_parquet(parquet_path))
-
-  return dfs
-
 def invertSummary(summary):
   inverted_summary = {}
   for proc_name in summary.keys():
     inverted_summary[summary[proc_name]] = proc_name
   return inverted_summary
 
-def idToName(dfs, summaries):
-  for i, df in enumerate(dfs):
-    inverted_summary = invertSummary(summaries[i])
-    df.process_id.replace(inverted_summary, inplace=True)  
-  return dfs
-
-def nameToId(df, summary):
-  df.process_id.replace(summary, inplace=True)
-  return df
-
-def removeExcludedProcesses(dfs, summaries, args):
-  for i, summary in enumerate(summaries):
-    for process in list(summary.keys()):
-      if process in args.exclude_procs:
-        dfs[i] = dfs[i][dfs[i].process_id != summary[process]]
-        del summary[process]        
-
-  return dfs, summaries
+def unifySchemas(schemas):
+  """Union of the columns in all schemas. A column takes its type from the first schema it appears in."""
+  fields = {}
+  for schema in schemas:
+    for field in schema:
+      if field.name not in fields: fields[field.name] = field
+  return pa.schema(list(fields.values()), metadata=schemas[0].metadata)
+
+def conformBatch(batch, schema, replace={}):
+  """Cast a record batch to the unified schema, filling columns it does not have with nulls. Columns in replace are swapped for the given arrays."""
+  columns = []
+  for field in schema:
+    i = batch.schema.get_field_index(field.name)
+    if field.name in replace: columns.append(pa.array(replace[field.name], type=field.type))
+    elif i == -1:             columns.append(pa.nulls(len(batch), type=field.type))
+    else:                     columns.append(batch.column(i).cast(field.type))
+  return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+def makeIdMap(summary, merged_summary, exclude_procs=[]):
+  """Lookup array from process ids in summary to ids in merged_summary. Excluded (or unknown) processes map to -1."""
+  id_map = np.full(max(summary.values())+1, -1, dtype=np.int64)
+  for proc, i in summary.items():
+    if proc not in exclude_procs:
+      id_map[i] = merged_summary[proc]
+  return id_map
+
+def streamMerge(parquet_inputs, parquet_output, id_maps=None, batch_size=100000, partitioned=False):
+  """
+  Merge parquet files by streaming record batches from each input into a single writer.
+  Only one batch is held in memory at a time. If id_maps is given, process_id in the i'th input is
+  remapped through id_maps[i] and rows that map to -1 are dropped.
+  If partitioned, parquet_output is a dataset directory partitioned by year and process_id (see parquet_loader.py).
+  Returns {process_id: [partition directories]} for a partitioned output.
+  """
+  files = [pq.ParquetFile(path) for path in parquet_inputs]
+  schema = unifySchemas([f.schema_arrow for f in files])
+
+  if id_maps != None:
+    max_id = max([id_map.max() for id_map in id_maps])
+    if max_id > np.iinfo(schema.field("process_id").type.to_pandas_dtype()).max:
+      schema = schema.set(schema.get_field_index("process_id"), pa.field("process_id", pa.int64()))
+
+  def batches():
+    for i, f in enumerate(files):
+      for batch in tqdm(f.iter_batches(batch_size=batch_size), total=int(np.ceil(f.metadata.num_rows/batch_size)), desc=parquet_inputs[i]):
+        replace = {}
+        if id_maps != None:
+          ids = batch.column(batch.schema.get_field_index("process_id")).to_numpy()
+          new_ids = id_maps[i][np.minimum(ids, len(id_maps[i])-1)]
+          new_ids[ids >= len(id_maps[i])] = -1
+          keep = new_ids >= 0
+          batch = batch.filter(pa.array(keep))
+          replace["process_id"] = new_ids[keep]
+        yield conformBatch(batch, schema, replace)
+
+  if not partitioned:
+    writer = pq.ParquetWriter(parquet_output, schema)
+    for batch in batches():
+      writer.write_table(pa.Table.from_batches([batch]))
+    writer.close()
+    return None
+
+  partitions = {}
+  def recordPartitions(batches):
+    for batch in batches:
+      keys = pd.DataFrame({column: batch.column(batch.schema.get_field_index(column)).to_numpy() for column in parquet_loader.partition_columns}).drop_duplicates()
+      for year, process_id in keys.itertuples(index=False):
+        partitions.setdefault(int(process_id), set()).add("year=%d/process_id=%d"%(year, process_id))
+      yield batch
+
+  partitioning = ds.partitioning(pa.schema([schema.field(column) for column in parquet_loader.partition_columns]), flavor="hive")
+  #use_threads=False keeps the rows of each partition in input order
+  ds.write_dataset(recordPartitions(batches()), parquet_output, schema=schema, format="parquet", partitioning=partitioning,
+                   basename_template="part-{i}.parquet", use_threads=False, existing_data_behavior="delete_matching")
+  parquet_loader.writePartitioningInfo(parquet_output, schema, partitions)
+  return {process_id: sorted(directories) for process_id, directories in partitions.items()}
+
+def processOrder(parquet_inputs, summaries, exclude_procs):
+  """Process names in the order they first appear in the concatenated inputs. Only the process_id column is read."""
+  order = []
+  for path, summary in zip(parquet_inputs, summaries):
+    inverted_summary = invertSummary(summary)
+    ids = pd.unique(pq.read_table(path, columns=["process_id"]).column(0).to_numpy())
+    order += [inverted_summary[i] for i in ids if (i in inverted_summary) and (inverted_summary[i] not in exclude_procs)]
+  return list(dict.fromkeys(order))
 
 def mergeDataFrames(args):
   summaries = loadSummaries(args)
-  dfs = loadDataFrames(args)
-
-  dfs, summaries = removeExcludedProcesses(dfs, summaries, args)
-  dfs = idToName(dfs, summaries)
 
   merged_summary = {}
   for summary in summaries: merged_summary.update(summary)
 
   if len(merged_summary.keys()) == sum([len(summary.keys()) for summary in summaries]): #no conflict
     print(">> No overlapping process names")
-    merged_df = pd.concat(dfs)
-    merged_summary = {process:i for i, process in enumerate(merged_df.process_id.unique())}
+    merged_summary = {process:i for i, process in enumerate(processOrder(args.parquet_input, summaries, args.exclude_procs))}
   else:
     print("Have not implemented a way to deal with conflicting process names yet. Script will now exit.")
     exit()
 
-  merged_df = nameToId(merged_df, merged_summary)
+  id_maps = [makeIdMap(summary, merged_summary, args.exclude_procs) for summary in summaries]
+  partitions = streamMerge(args.parquet_input, args.parquet_output, id_maps, args.batch_size, args.partitioned)
+  event_index.writeIndex(args.parquet_output)
+  if args.tiers != None:
+    dataset_tiers.writeTiers(args.parquet_output, args.tiers, batch_size=args.batch_size)
 
-  merged_df.to_parquet(args.parquet_output)
+  summary = {"sample_id_map": merged_summary}
+  if partitions != None: #process name -> partition directories
+    summary["partitions"] = {process:partitions[i] for process, i in merged_summary.items() if i in partitions}
   with open(args.summary_output, "w") as f:
-    json.dump({"sample_id_map": merged_summary}, f, indent=4)  
+    json.dump(summary, f, indent=4)  
 
 if __name__=="__main__":
   parser = argparse.ArgumentParser()
@@ -77,6 +147,10 @@ if __name__=="__main__":
 
   parser.add_argument('--exclude-procs', '-e', type=str, nargs='+', default=[], help="List of processes to not include in the merging, e.g. Diphoton TTGamma ...")
 
+  parser.add_argument('--batch-size', type=int, default=100000, help="Number of rows read from an input at a time.")
+  parser.add_argument('--partitioned', default=False, action="store_true", help="Write the output as a directory partitioned by year and process_id instead of a single parquet file.")
+  parser.add_argument('--tiers', type=float, nargs="+", default=None, help="Also write stratified subsample tiers of the output with these fractions of events, e.g. 0.01 0.1 (see dataset_tiers.py).")
+
   parser.add_argument('--force', '-f', default=False, action="store_true", help="Overwrite output parquet and summary files without asking permission.")
 
   args = parser.parse_args()
@@ -90,5 +164,12 @@ if __name__=="__main__":
 
   assert len(args.parquet_input) == len(args.summary_input)
 
+  stale = preprocessing_cache.checkOutputs(args.parquet_input)
+  for path, reason in stale:
+    print("%s is out of date: %s"%(path, reason))
+  if (len(stale) > 0) and (not args.force):
+    if input("Some inputs are out of date. Should we continue anyway? (y/n): ") == "n":
+      exit()
+
   mergeDataFrames(args)
 
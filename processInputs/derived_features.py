@@ -0,0 +1,169 @@
+"""
+Derived features added during preprocessing, declared as nodes of a dependency graph.
+
+Each node lists the columns it produces and the columns it reads. Given a set of requested
+columns, only the nodes in their dependency closure are evaluated, so trimmed feature sets
+(e.g. important_17_corr) skip most of the work. Nodes must be declared after any node they
+depend on and are evaluated in declaration order.
+
+The angular separations (deta, dphi, dR) are all evaluated together by angular_kernels in a single
+pass at the position of the first one that is needed.
+"""
+
+import numpy as np
+import common
+import mass_variables
+import angular_kernels
+
+nodes = []
+features = {} #output column -> node
+
+def feature(outputs, inputs, angular=None):
+  """
+  Decorator registering a function(df, p4) that adds the outputs columns to df using the inputs columns.
+  angular nodes (see angularFeature) are evaluated together instead of through their function.
+  """
+  def register(function):
+    node = {"outputs": outputs, "inputs": inputs, "function": function, "angular": angular}
+    for column in outputs:
+      assert not any(column in each["inputs"] for each in nodes), "%s must be declared before it is used"%column
+    nodes.append(node)
+    for column in outputs:
+      features[column] = node
+    return function
+  return register
+
+def requiredNodes(requested=None):
+  """Nodes needed to produce the requested columns, in evaluation order. requested=None means every node."""
+  if requested == None: return list(nodes)
+
+  required = set()
+  seen = set()
+  to_visit = list(requested)
+  while len(to_visit) > 0:
+    column = to_visit.pop()
+    if (column in seen) or (column not in features): continue
+    seen.add(column)
+    node = features[column]
+    if id(node) not in required:
+      required.add(id(node))
+      to_visit.extend(node["inputs"])
+
+  return [node for node in nodes if id(node) in required]
+
+def inputColumns(requested=None):
+  """Columns that must be present in the input to produce the requested columns"""
+  required = requiredNodes(requested)
+  produced = set([column for node in required for column in node["outputs"]])
+
+  columns = []
+  for node in required:
+    #a node can read a column it overwrites (e.g. ditau_dphi) in which case it is an input
+    columns += [column for column in node["inputs"] if (column not in produced) or (column in node["outputs"])]
+  if requested != None:
+    columns += [column for column in requested if column not in features]
+  return list(dict.fromkeys(columns))
+
+def addAngularFeatures(df, angular_nodes):
+  """Evaluate the angular nodes with a single call to angular_kernels.angularSeparations"""
+  specs = [node["angular"] for node in angular_nodes]
+  objects = list(dict.fromkeys([obj for spec in specs for obj in [spec["a"], spec["b"]]]))
+  needs_eta = set([obj for spec in specs if spec["quantities"] != ["dphi"] for obj in [spec["a"], spec["b"]]])
+
+  eta = np.zeros((len(objects), len(df)), dtype=np.float32) #objects without eta (MET) are only used for dphi
+  phi = np.empty((len(objects), len(df)), dtype=np.float32)
+  for i, obj in enumerate(objects):
+    if obj in needs_eta: eta[i] = df[obj+"_eta"].to_numpy()
+    phi[i] = df[obj+"_phi"].to_numpy()
+
+  pairs = [[objects.index(spec["a"]), objects.index(spec["b"])] for spec in specs]
+  masked = [spec["single_lepton_dummy"] for spec in specs]
+  single_lepton = (df.category==8).to_numpy() if any(masked) else np.zeros(len(df), dtype=bool)
+
+  deta, delta_phi, dR = angular_kernels.angularSeparations(eta, phi, pairs, masked, single_lepton, common.dummy_val)
+  values = {"deta": deta, "dphi": delta_phi, "dR": dR}
+  for p, spec in enumerate(specs):
+    for quantity, column in spec["outputs"].items():
+      df[column] = values[quantity][p]
+
+def addFeatures(df, requested=None):
+  p4 = mass_variables.FourVectors(df)
+  required = requiredNodes(requested)
+  angular_nodes = [node for node in required if node["angular"] != None]
+
+  done = set()
+  for node in required:
+    if id(node) in done: continue
+    if node["angular"] == None:
+      node["function"](df, p4)
+      done.add(id(node))
+    else:
+      #all angular nodes are evaluated now so none of their inputs may come from a node that has not run yet
+      produced_later = set([column for other in required if (id(other) not in done) and (other["angular"] == None) for column in other["outputs"]])
+      assert not any(column in produced_later for other in angular_nodes for column in other["inputs"])
+      addAngularFeatures(df, angular_nodes)
+      done.update([id(other) for other in angular_nodes])
+
+def angularFeature(prefix, a, b, quantities, single_lepton_dummy, names={}):
+  """
+  Register a node for the deta/dphi/dR between objects a and b, named prefix_deta etc. unless given in names.
+  If single_lepton_dummy, the outputs are set to common.dummy_val for single lepton events (category 8).
+  """
+  outputs = {quantity: names.get(quantity, "%s_%s"%(prefix, quantity)) for quantity in quantities}
+  inputs = [a+"_phi", b+"_phi"] if quantities == ["dphi"] else [a+"_eta", a+"_phi", b+"_eta", b+"_phi"]
+  if single_lepton_dummy: inputs.append("category")
+  angular = {"a": a, "b": b, "quantities": quantities, "outputs": outputs, "single_lepton_dummy": single_lepton_dummy}
+
+  @feature(list(outputs.values()), inputs, angular)
+  def add(df, p4):
+    addAngularFeatures(df, [features[outputs[quantities[0]]]])
+  return add
+
+@feature(["ditau_phi"], ["lead_lepton_pt", "lead_lepton_phi", "sublead_lepton_pt", "sublead_lepton_phi"])
+def add_ditau_phi(df, p4):
+  tau1_px = df.lead_lepton_pt * np.cos(df.lead_lepton_phi)
+  tau1_py = df.lead_lepton_pt * np.sin(df.lead_lepton_phi)
+  tau2_px = df.sublead_lepton_pt * np.cos(df.sublead_lepton_phi)
+  tau2_py = df.sublead_lepton_pt * np.sin(df.sublead_lepton_phi)
+
+  ditau_px = tau1_px + tau2_px
+  ditau_py = tau1_py + tau2_py
+  df["ditau_phi"] = np.arctan2(ditau_py, ditau_px)
+
+# met_dphi variables already exist for diphoton and lead_lepton
+angularFeature("ditau_met", "MET", "ditau", ["dphi"], False, {"dphi": "ditau_met_dPhi"})
+angularFeature("sublead_lepton_met", "MET", "sublead_lepton", ["dphi"], True, {"dphi": "sublead_lepton_met_dPhi"})
+
+angularFeature("Diphoton", "LeadPhoton", "SubleadPhoton", ["deta", "dR"], False)
+angularFeature("ditau", "lead_lepton", "sublead_lepton", ["deta"], True)
+
+@feature(["ditau_dphi"], ["ditau_dphi", "category"])
+def mask_ditau_dphi(df, p4):
+  df["ditau_dphi"] = np.where(p4.singleLepton(), np.float32(common.dummy_val), df["ditau_dphi"].to_numpy())
+
+angularFeature("Diphoton_lead_lepton", "Diphoton", "lead_lepton", ["deta", "dphi", "dR"], False)
+angularFeature("Diphoton_sublead_lepton", "Diphoton", "sublead_lepton", ["deta", "dphi", "dR"], True)
+angularFeature("Diphoton_ditau", "Diphoton", "ditau", ["deta", "dphi", "dR"], True)
+
+#zgamma variables
+angularFeature("LeadPhoton_ditau", "LeadPhoton", "ditau", ["dR"], True)
+angularFeature("SubleadPhoton_ditau", "SubleadPhoton", "ditau", ["dR"], True)
+angularFeature("LeadPhoton_lead_lepton", "LeadPhoton", "lead_lepton", ["dR"], False)
+angularFeature("SubleadPhoton_lead_lepton", "SubleadPhoton", "lead_lepton", ["dR"], False)
+angularFeature("LeadPhoton_sublead_lepton", "LeadPhoton", "sublead_lepton", ["dR"], True)
+angularFeature("SubleadPhoton_sublead_lepton", "SubleadPhoton", "sublead_lepton", ["dR"], True)
+
+@feature(["LeadPhoton_pt_mgg", "SubleadPhoton_pt_mgg"], ["LeadPhoton_pt", "SubleadPhoton_pt", "Diphoton_mass"])
+def dividePhotonPT(df, p4):
+  df["LeadPhoton_pt_mgg"] = df["LeadPhoton_pt"] / df["Diphoton_mass"]
+  df["SubleadPhoton_pt_mgg"] = df["SubleadPhoton_pt"] / df["Diphoton_mass"]
+
+diphoton_p4 = ["Diphoton_pt", "Diphoton_eta", "Diphoton_phi", "Diphoton_mass"]
+ditau_p4 = ["ditau_pt", "ditau_eta", "ditau_phi", "ditau_mass"]
+lead_lepton_p4 = ["lead_lepton_pt", "lead_lepton_eta", "lead_lepton_phi", "lead_lepton_mass"]
+met_p4 = ["MET_pt", "MET_phi"]
+
+feature(["reco_MX", "reco_MX_mgg"], diphoton_p4 + ditau_p4 + ["category"])(mass_variables.add_reco_MX)
+feature(["reco_MX_MET", "reco_MX_MET_mgg"], diphoton_p4 + ditau_p4 + met_p4 + ["category"])(mass_variables.add_reco_MX_met4)
+feature(["reco_Mggtau", "reco_Mggtau_mgg", "reco_Mggtau_mgg2"], diphoton_p4 + lead_lepton_p4)(mass_variables.add_Mggt)
+feature(["reco_MggtauMET", "reco_MggtauMET_mgg"], diphoton_p4 + lead_lepton_p4 + met_p4)(mass_variables.add_Mggt_met1)
@@ -0,0 +1,135 @@
+"""
+Generate synthetic HiggsDNA-like parquet files for benchmarking the preprocessing without the production inputs.
+
+The files have the input columns of common.all_columns with HiggsDNA dtypes (float64 kinematics and
+weights, int64 ids, bytes year). Single lepton events (category 8) have their sublead lepton and
+ditau variables set to common.dummy_val, as do events with fewer than two jets, and a small fraction
+of NaNs and infs is injected so that sanitise has work to do. The distributions are only roughly physical.
+
+Output layout matches the HiggsDNA output read by process_HiggsDNA_Inputs_batch.py:
+  <output-dir>/summary.json
+  <output-dir>/<folder>/<folder>_<i>.parquet
+"""
+
+import argparse
+import os
+import json
+import numpy as np
+import pandas as pd
+import common
+import derived_features
+
+int_columns = ["process_id", "category", "n_electrons", "n_muons", "n_taus", "n_iso_tracks", "n_jets", "n_bjets", "LeadPhoton_pixelSeed", "SubleadPhoton_pixelSeed", "LeadPhoton_genPartFlav", "SubleadPhoton_genPartFlav", "lead_lepton_id", "sublead_lepton_id", "lead_lepton_charge", "sublead_lepton_charge"]
+
+def inputColumns():
+  """Columns present in the HiggsDNA output, i.e. common.all_columns without the ones added by preprocessing"""
+  columns = [column for column in common.all_columns if (column not in derived_features.features) and (column not in ["MX", "MY"])]
+  columns += derived_features.inputColumns() #includes columns that are overwritten, e.g. ditau_dphi
+  return list(dict.fromkeys(columns))
+
+def defaultProcesses():
+  return ["Data"] + common.bkg_procs["all"] + common.sig_procs["Graviton"][:5] + common.sig_procs["NMSSM_Y_gg"][:5]
+
+def generateColumn(column, n, rng, signal):
+  if column == "Diphoton_mass":
+    return np.where(signal, rng.normal(125, 1.5, n), 100 + rng.exponential(30, n))
+  elif column.endswith("_eta"):
+    return rng.uniform(-2.5, 2.5, n)
+  elif column.endswith("_phi") or column.endswith("_dphi") or column.endswith("_dPhi"):
+    return rng.uniform(-np.pi, np.pi, n)
+  elif column.endswith("_pt") or column.endswith("_mass"):
+    return 20 + rng.exponential(40, n)
+  elif column.endswith("_mvaID") or column.endswith("btagDeepFlavB"):
+    return rng.uniform(-1, 1, n)
+  elif "weight" in column:
+    return rng.normal(1, 0.1, n) if column != "weight_central" else rng.exponential(0.01, n)
+  else:
+    return rng.normal(0, 1, n)
+
+def parseProcesses(processes):
+  """Parse a list of process or process:fraction strings into {process: fraction}. Fractions default to 1 and are normalised."""
+  fractions = {}
+  for each in processes:
+    name, fraction = (each.split(":") + ["1"])[:2]
+    fractions[name] = float(fraction)
+  total = sum(fractions.values())
+  return {name: fraction/total for name, fraction in fractions.items()}
+
+def generateDataFrame(n, proc_dict, fractions, year, rng, first_event=1, nan_fraction=1e-3, inf_fraction=1e-4):
+  processes = list(fractions.keys())
+  process_id = rng.choice([proc_dict[proc] for proc in processes], n, p=[fractions[proc] for proc in processes])
+  signal = np.isin(process_id, [proc_dict[proc] for proc in processes if proc in common.sig_procs["all"]])
+  category = rng.integers(1, 9, n)
+  single_lepton = category == 8
+
+  columns = {}
+  for column in inputColumns():
+    if column in int_columns: continue
+    columns[column] = generateColumn(column, n, rng, signal)
+
+  columns["process_id"] = process_id
+  columns["category"] = category
+  for column in ["n_electrons", "n_muons", "n_taus", "n_iso_tracks", "n_bjets"]:
+    columns[column] = rng.integers(0, 3, n)
+  columns["n_jets"] = rng.integers(0, 5, n)
+  for column in ["LeadPhoton_pixelSeed", "SubleadPhoton_pixelSeed"]:
+    columns[column] = (rng.uniform(size=n) < 0.05).astype(np.int64)
+  for column in ["LeadPhoton_genPartFlav", "SubleadPhoton_genPartFlav"]:
+    columns[column] = rng.choice([0, 1, 11, 13, 15, 22], n)
+  columns["lead_lepton_id"] = rng.choice([-15, -13, -11, 11, 13, 15], n)
+  columns["sublead_lepton_id"] = rng.choice([-15, -13, -11, 11, 13, 15], n)
+  columns["lead_lepton_charge"] = np.sign(columns["lead_lepton_id"])
+  columns["sublead_lepton_charge"] = np.sign(columns["sublead_lepton_id"])
+  columns["event"] = rng.permutation(n).astype(np.uint64) + np.uint64(first_event) #unique so that event indexes can be built
+  columns["year"] = np.full(n, year.encode())
+
+  #missing objects
+  for column in columns.keys():
+    if (column.startswith("sublead_lepton") or column.startswith("ditau")) and (column not in ["year", "event"]):
+      columns[column] = np.where(single_lepton, common.dummy_val, columns[column]).astype(columns[column].dtype)
+    if column.startswith("jet_2") or column.startswith("b_jet_1"):
+      columns[column] = np.where(columns["n_jets"] < 2, common.dummy_val, columns[column])
+
+  df = pd.DataFrame(columns)[inputColumns()]
+
+  #corrupt values for sanitise to deal with
+  float_columns = [column for column in df.columns if df[column].dtype == np.float64]
+  for fraction, value in [(nan_fraction, np.nan), (inf_fraction, np.inf)]:
+    for column in rng.choice(float_columns, 3, replace=False):
+      df.loc[rng.uniform(size=n) < fraction, column] = value
+
+  return df
+
+def main(args):
+  rng = np.random.default_rng(args.seed)
+  fractions = parseProcesses(defaultProcesses() if args.processes == None else args.processes)
+  proc_dict = {proc: i for i, proc in enumerate(fractions.keys())}
+
+  os.makedirs(args.output_dir, exist_ok=True)
+  with open(os.path.join(args.output_dir, "summary.json"), "w") as f:
+    json.dump({"sample_id_map": proc_dict}, f, indent=4)
+
+  n_written = 0
+  for folder in args.folders:
+    os.makedirs(os.path.join(args.output_dir, folder), exist_ok=True)
+    for i in range(args.n_files):
+      year = args.years[i % len(args.years)]
+      df = generateDataFrame(args.n_events, proc_dict, fractions, year, rng, first_event=1+n_written*args.n_events)
+      n_written += 1
+      path = os.path.join(args.output_dir, folder, "%s_%d.parquet"%(folder, i))
+      df.to_parquet(path, row_group_size=args.row_group_size)
+      print(">> Written %s (%d events)"%(path, len(df)))
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--output-dir', '-o', type=str, required=True)
+  parser.add_argument('--folders', type=str, nargs="+", default=["low_mass"])
+  parser.add_argument('--n-files', type=int, default=1, help="Number of files per folder.")
+  parser.add_argument('--n-events', type=int, default=100000, help="Number of events per file.")
+  parser.add_argument('--processes', type=str, nargs="+", default=None, help="Processes to generate, optionally with their fraction of events, e.g. Data:10 DiPhoton:5 ggH_M125. Default is an equal mix of Data, all backgrounds and a few signals.")
+  parser.add_argument('--years', type=str, nargs="+", default=["2016UL_pre", "2016UL_pos", "2017", "2018"])
+  parser.add_argument('--row-group-size', type=int, default=None)
+  parser.add_argument('--seed', type=int, default=1)
+  args = parser.parse_args()
+
+  main(args)
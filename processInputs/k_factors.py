@@ -1,48 +1,121 @@
 import numpy as np
+import pandas as pd
 import scipy.optimize as spo
 
-def createHistograms(data, mc, features, feature_ranges="auto"):
-  hists = []
-  for i, feature in enumerate(features):
-    print(feature)
+def binIndex(x, edges):
+  """Bin of each value of x (same convention as np.histogram), -1 for values outside the edges"""
+  idx = np.searchsorted(edges, x, side="right") - 1
+  idx[x == edges[-1]] = len(edges) - 2 #last bin includes its right edge
+  idx[(idx < 0) | (idx >= len(edges)-1)] = -1
+  return idx
 
+def featureEdges(data, mc, features, feature_ranges="auto", nbins=100):
+  """Bin edges of each feature, ranges of "auto" go from the minimum to the 95% quantile of data and mc"""
+  edges = []
+  for i, feature in enumerate(features):
     if feature_ranges == "auto":
       feature_range = [min([data[feature].quantile(0.0), mc[feature].quantile(0.0)]), max([data[feature].quantile(0.95), mc[feature].quantile(0.95)])]
     else:
       feature_range = feature_ranges[i]
-    print(feature_range)
-
-    data_hist, edges = np.histogram(data[feature], bins=100, range=feature_range, weights=data.weight_central)
-    data_hist_err = np.sqrt(data_hist)
-
-    mc_hists = []
-    mc_hists_err = []
-    for proc in mc.bkg_group.unique():
-      print(proc)
-      N, edges = np.histogram(mc.loc[mc.bkg_group==proc, feature], bins=edges)
-      mc_hist, edges = np.histogram(mc.loc[mc.bkg_group==proc, feature], bins=edges, weights=mc.loc[mc.bkg_group==proc, "weight_central"])
-      mc_hist_err = np.nan_to_num(mc_hist / np.sqrt(N))
-
-      mc_hists.append(mc_hist)
-      mc_hists_err.append(mc_hist_err)
-
-    mc_hists = np.array(mc_hists)
-    mc_hists_err = np.array(mc_hists_err)
-
-    hists.append([data_hist, data_hist_err, mc_hists, mc_hists_err])
-  return hists
+    print(feature, feature_range)
+    edges.append(np.linspace(feature_range[0], feature_range[1], nbins+1))
+  return edges
+
+def createHistograms(data, mc, features, feature_ranges="auto", nbins=100):
+  """
+  Histogram every feature for data and for each background group in one pass per feature.
+  Returns (data_hists, data_hists_err, mc_hists, mc_hists_err) with shapes (feature, bin) for data
+  and (feature, group, bin) for mc. Groups are in the order of mc.bkg_group.unique().
+  """
+  group_idx, groups = pd.factorize(mc.bkg_group)
+  n_groups = len(groups)
+  data_w = data.weight_central.to_numpy()
+  mc_w = mc.weight_central.to_numpy()
+
+  data_hists = np.zeros((len(features), nbins))
+  mc_hists = np.zeros((len(features), n_groups, nbins))
+  mc_N = np.zeros((len(features), n_groups, nbins))
+  for i, (feature, edges) in enumerate(zip(features, featureEdges(data, mc, features, feature_ranges, nbins))):
+    idx = binIndex(data[feature].to_numpy(), edges)
+    s = idx >= 0
+    data_hists[i] = np.bincount(idx[s], weights=data_w[s], minlength=nbins)
+
+    #flat index of (group, bin) so that all groups are filled by one bincount
+    idx = binIndex(mc[feature].to_numpy(), edges)
+    s = idx >= 0
+    flat_idx = group_idx[s]*nbins + idx[s]
+    mc_hists[i] = np.bincount(flat_idx, weights=mc_w[s], minlength=n_groups*nbins).reshape(n_groups, nbins)
+    mc_N[i] = np.bincount(flat_idx, minlength=n_groups*nbins).reshape(n_groups, nbins)
+
+  return histogramErrors(data_hists, mc_hists, mc_N)
+
+def histogramErrors(data_hists, mc_hists, mc_N):
+  data_hists_err = np.sqrt(data_hists)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    mc_hists_err = np.nan_to_num(mc_hists / np.sqrt(mc_N))
+  return data_hists, data_hists_err, mc_hists, mc_hists_err
+
+def createReplicaHistograms(data, mc, features, n_replicas, rng, feature_ranges="auto", nbins=100, max_elements=2**24):
+  """
+  Histograms of n_replicas Poisson bootstrap replicas, where every event's weight is multiplied by a
+  Poisson(1) number drawn per replica. The binning is that of the nominal histograms and each event is
+  binned once. The replica weights are drawn for as many replicas at a time as fit in max_elements
+  (per event) and all of those replicas are filled by one bincount per feature.
+  Returns the same as createHistograms with an extra leading replica axis.
+  """
+  group_idx, groups = pd.factorize(mc.bkg_group)
+  n_groups = len(groups)
+  data_w = data.weight_central.to_numpy()
+  mc_w = mc.weight_central.to_numpy()
+
+  edges = featureEdges(data, mc, features, feature_ranges, nbins)
+  data_idx = [binIndex(data[feature].to_numpy(), e) for feature, e in zip(features, edges)]
+  mc_idx = [binIndex(mc[feature].to_numpy(), e) for feature, e in zip(features, edges)]
+
+  data_hists = np.zeros((n_replicas, len(features), nbins))
+  mc_hists = np.zeros((n_replicas, len(features), n_groups, nbins))
+  mc_N = np.zeros((n_replicas, len(features), n_groups, nbins))
+
+  chunk_size = max(1, max_elements // max(len(data), len(mc), 1))
+  for start in range(0, n_replicas, chunk_size):
+    n = min(chunk_size, n_replicas-start)
+    replica = np.arange(n)[:,np.newaxis]
+    data_p = rng.poisson(1.0, (n, len(data)))
+    mc_p = rng.poisson(1.0, (n, len(mc)))
+
+    for i in range(len(features)):
+      #flat index of (replica, bin) and (replica, group, bin)
+      s = data_idx[i] >= 0
+      flat_idx = (replica*nbins + data_idx[i][s]).ravel()
+      data_hists[start:start+n, i] = np.bincount(flat_idx, weights=(data_p[:,s]*data_w[s]).ravel(), minlength=n*nbins).reshape(n, nbins)
+
+      s = mc_idx[i] >= 0
+      flat_idx = (replica*(n_groups*nbins) + group_idx[s]*nbins + mc_idx[i][s]).ravel()
+      mc_hists[start:start+n, i] = np.bincount(flat_idx, weights=(mc_p[:,s]*mc_w[s]).ravel(), minlength=n*n_groups*nbins).reshape(n, n_groups, nbins)
+      mc_N[start:start+n, i] = np.bincount(flat_idx, weights=mc_p[:,s].ravel(), minlength=n*n_groups*nbins).reshape(n, n_groups, nbins)
+
+  return histogramErrors(data_hists, mc_hists, mc_N)
+
+def calculateChi2AndGradient(k_factors, hists):
+  """chi2 between data and the k-factor scaled mc summed over all features and bins, and its gradient wrt k_factors"""
+  k_factors = np.asarray(k_factors)
+  data_hists, data_hists_err, mc_hists, mc_hists_err = hists
+
+  mc_hist_sum = np.einsum("g,fgb->fb", k_factors, mc_hists)
+  mc_hists_var = mc_hists_err**2
+  var = data_hists_err**2 + np.einsum("g,fgb->fb", k_factors**2, mc_hists_var)
+
+  #bins that are empty in both data and mc do not contribute
+  s = var > 0
+  residual = np.where(s, data_hists - mc_hist_sum, 0)
+  pull = residual / np.where(s, var, 1)
+
+  chi2 = np.sum(residual * pull)
+  grad = -2*np.einsum("fgb,fb->g", mc_hists, pull) - 2*k_factors*np.einsum("fgb,fb->g", mc_hists_var, pull**2)
+  return chi2, grad
 
 def calculateChi2(k_factors, hists):
-  k_factors = np.array(k_factors)
-  chi2 = 0
-  for i, hist_collection in enumerate(hists):
-    mc_hist_sum = np.sum(hist_collection[2] * k_factors[:,np.newaxis], axis=0)
-    mc_hist_err_sum = np.sqrt(np.sum((hist_collection[3] * k_factors[:,np.newaxis])**2, axis=0))
-
-    data_hist, data_hist_err = hist_collection[0:2]
-
-    chi2 += np.sum( (data_hist - mc_hist_sum)**2/(data_hist_err**2 + mc_hist_err_sum**2) )
-  return chi2
+  return calculateChi2AndGradient(k_factors, hists)[0]
 
 def deriveScaleFactors(data, mc, features, k_factor_bounds=None):
   n_bkg_groups = len(mc.bkg_group.unique())
@@ -53,16 +126,36 @@ def deriveScaleFactors(data, mc, features, k_factor_bounds=None):
 
   hists = createHistograms(data, mc, features)
   print(calculateChi2(p0, hists))
-  res = spo.minimize(calculateChi2, p0, args=(hists), bounds=k_factor_bounds)
+  res = spo.minimize(calculateChi2AndGradient, p0, args=(hists,), jac=True, bounds=k_factor_bounds)
   return res.x
 
+def bootstrapScaleFactors(data, mc, features, n_replicas=100, k_factor_bounds=None, seed=None):
+  """
+  Nominal k-factors and the k-factors fitted to n_replicas Poisson bootstrap replicas of data and mc.
+  Every replica's fit starts from the nominal k-factors. The spread of the replica k-factors,
+  e.g. replica_k_factors.std(axis=0), is their statistical uncertainty.
+  Returns (k_factors, replica_k_factors) with shapes (group) and (replica, group).
+  """
+  n_bkg_groups = len(mc.bkg_group.unique())
+  if k_factor_bounds == None:
+    k_factor_bounds = [[0, 5] for i in range(n_bkg_groups)]
+
+  k_factors = deriveScaleFactors(data, mc, features, k_factor_bounds)
+  replica_hists = createReplicaHistograms(data, mc, features, n_replicas, np.random.default_rng(seed))
+
+  replica_k_factors = np.zeros((n_replicas, n_bkg_groups))
+  for i in range(n_replicas):
+    hists = tuple(h[i] for h in replica_hists)
+    res = spo.minimize(calculateChi2AndGradient, k_factors, args=(hists,), jac=True, bounds=k_factor_bounds)
+    replica_k_factors[i] = res.x
+  return k_factors, replica_k_factors
+
 def applyScaleFactors(mc, k_factors):
   for i, group in enumerate(mc.bkg_group.unique()):
     mc.loc[mc.bkg_group==group, "weight_central"] *= k_factors[i]
 
 if __name__=="__main__":
   import sys
-  import pandas as pd
   import json
   df = pd.read_parquet(sys.argv[1])
 
@@ -96,8 +189,14 @@ if __name__=="__main__":
 
   #bounds = [[0.99, 1.01], [0.1, 10], [0.1, 10], [0.1,10], [0.1, 10]]
   bounds = [[0.1, 5], [0.1, 5], [0.1, 5]]
-  k_factors = deriveScaleFactors(data, mc, ["Diphoton_pt", "LeadPhoton_pt", "SubleadPhoton_pt"], bounds)
-  print(k_factors)
+  features = ["Diphoton_pt", "LeadPhoton_pt", "SubleadPhoton_pt"]
+  if len(sys.argv) > 3: #number of bootstrap replicas
+    k_factors, replica_k_factors = bootstrapScaleFactors(data, mc, features, int(sys.argv[3]), bounds)
+    print(k_factors)
+    print(replica_k_factors.std(axis=0))
+  else:
+    k_factors = deriveScaleFactors(data, mc, features, bounds)
+    print(k_factors)
 
   applyScaleFactors(mc, k_factors)
   print(data.weight_central.sum())
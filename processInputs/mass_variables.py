@@ -6,28 +6,63 @@ The variables use some combination of the visible particles and the MET.
 import numpy as np
 import common
 
-def add_reco_MX(df):
-  H1_px = df.Diphoton_pt * np.cos(df.Diphoton_phi)
-  H1_py = df.Diphoton_pt * np.sin(df.Diphoton_phi)
-  H1_pz = df.Diphoton_pt * np.sinh(df.Diphoton_eta)
-  H1_P = df.Diphoton_pt * np.cosh(df.Diphoton_eta)
-  H1_E = np.sqrt(H1_P**2 + df.Diphoton_mass**2)
-
-  H2_px = df.ditau_pt * np.cos(df.ditau_phi)
-  H2_py = df.ditau_pt * np.sin(df.ditau_phi)
-  H2_pz = df.ditau_pt * np.sinh(df.ditau_eta)
-  H2_P = df.ditau_pt * np.cosh(df.ditau_eta)
-  H2_E = np.sqrt(H2_P**2 + df.ditau_mass**2)
-
-  HH_px = H1_px + H2_px
-  HH_py = H1_py + H2_py
-  HH_pz = H1_pz + H2_pz
-  HH_E = H1_E + H2_E
-
-  df["reco_MX"] = np.sqrt(HH_E**2 - HH_px**2 - HH_py**2 - HH_pz**2)
-  df["reco_MX_mgg"] = df["reco_MX"] / df["Diphoton_mass"]
-  df.loc[df.category == 8, "reco_MX"] = common.dummy_val
-  df.loc[df.category == 8, "reco_MX_mgg"] = common.dummy_val
+class FourVectors:
+  """
+  Cartesian components (px, py, pz, E) of the physics objects in a dataframe, stored as float32 arrays.
+  Each object is only computed the first time it is asked for, so all the mass variables
+  built from the same FourVectors share a single pass of cos/sin/sinh/cosh per object.
+  Objects are given by their column prefix, e.g. "Diphoton", "ditau", "lead_lepton" or "MET".
+  """
+  def __init__(self, df):
+    self.df = df
+    self.cache = {}
+    self.columns = {}
+
+  def column(self, name):
+    if name not in self.columns:
+      self.columns[name] = self.df[name].to_numpy(dtype=np.float32)
+    return self.columns[name]
+
+  def __getitem__(self, obj):
+    if obj not in self.cache:
+      self.cache[obj] = self.compute(obj)
+    return self.cache[obj]
+
+  def compute(self, obj):
+    pt = self.column(obj+"_pt")
+    phi = self.column(obj+"_phi")
+    px = pt * np.cos(phi)
+    py = pt * np.sin(phi)
+
+    if obj == "MET": #massless and only transverse
+      return px, py, np.zeros_like(pt), pt
+
+    eta = self.column(obj+"_eta")
+    mass = self.column(obj+"_mass")
+    pz = pt * np.sinh(eta)
+    E = np.sqrt((pt * np.cosh(eta))**2 + mass**2)
+    return px, py, pz, E
+
+  def mgg(self):
+    return self.column("Diphoton_mass")
+
+  def singleLepton(self):
+    return (self.df.category == 8).to_numpy()
+
+def invariantMass(px, py, pz, E):
+  return np.sqrt(E**2 - px**2 - py**2 - pz**2)
+
+def add_reco_MX(df, p4=None):
+  if p4 is None: p4 = FourVectors(df)
+  H1_px, H1_py, H1_pz, H1_E = p4["Diphoton"]
+  H2_px, H2_py, H2_pz, H2_E = p4["ditau"]
+
+  reco_MX = invariantMass(H1_px+H2_px, H1_py+H2_py, H1_pz+H2_pz, H1_E+H2_E)
+  reco_MX_mgg = reco_MX / p4.mgg()
+
+  single_lepton = p4.singleLepton()
+  df["reco_MX"] = np.where(single_lepton, np.float32(common.dummy_val), reco_MX)
+  df["reco_MX_mgg"] = np.where(single_lepton, np.float32(common.dummy_val), reco_MX_mgg)
 
 # def add_MX_met1(df):
 #   H1_px = df.Diphoton_pt * np.cos(df.Diphoton_phi)
@@ -96,77 +131,53 @@ def add_reco_MX(df):
 #   df["reco_MX_met3"] = np.sqrt(HH_E**2 - HH_px**2 - HH_py**2 - HH_pz**2)
 #   df.loc[df.category == 8, "reco_MX_met3"] = common.dummy_val
 
-def add_reco_MX_met4(df):
-  H1_px = df.Diphoton_pt * np.cos(df.Diphoton_phi)
-  H1_py = df.Diphoton_pt * np.sin(df.Diphoton_phi)
-  H1_pz = df.Diphoton_pt * np.sinh(df.Diphoton_eta)
-  H1_P = df.Diphoton_pt * np.cosh(df.Diphoton_eta)
-  H1_E = np.sqrt(H1_P**2 + df.Diphoton_mass**2)
-
-  H2_px = df.ditau_pt * np.cos(df.ditau_phi) + df.MET_pt * np.cos(df.MET_phi)
-  H2_py = df.ditau_pt * np.sin(df.ditau_phi) + df.MET_pt * np.sin(df.MET_phi)
-  H2_pz = df.ditau_pt * np.sinh(df.ditau_eta) * 2
-  H2_P = np.sqrt(H2_px**2 + H2_py**2 + H2_pz**2)
-  H2_E = np.sqrt(H2_P**2 + df.ditau_mass**2)
-
-  HH_px = H1_px + H2_px
-  HH_py = H1_py + H2_py
-  HH_pz = H1_pz + H2_pz
-  HH_E = H1_E + H2_E
-
-  df["reco_MX_MET"] = np.sqrt(HH_E**2 - HH_px**2 - HH_py**2 - HH_pz**2)
-  df["reco_MX_MET_mgg"] = df["reco_MX_MET"] / df["Diphoton_mass"]
-  df.loc[df.category == 8, "reco_MX_MET"] = common.dummy_val
-  df.loc[df.category == 8, "reco_MX_MET_mgg"] = common.dummy_val
-
-def add_Mggt(df):
-  H1_px = df.Diphoton_pt * np.cos(df.Diphoton_phi)
-  H1_py = df.Diphoton_pt * np.sin(df.Diphoton_phi)
-  H1_pz = df.Diphoton_pt * np.sinh(df.Diphoton_eta)
-  H1_P = df.Diphoton_pt * np.cosh(df.Diphoton_eta)
-  H1_E = np.sqrt(H1_P**2 + df.Diphoton_mass**2)
-
-  H2_px = df.lead_lepton_pt * np.cos(df.lead_lepton_phi)
-  H2_py = df.lead_lepton_pt * np.sin(df.lead_lepton_phi)
-  H2_pz = df.lead_lepton_pt * np.sinh(df.lead_lepton_eta)
-  H2_P = df.lead_lepton_pt * np.cosh(df.lead_lepton_eta)
-  H2_E = np.sqrt(H2_P**2 + df.lead_lepton_mass**2)
-
-  HH_px = H1_px + H2_px
-  HH_py = H1_py + H2_py
-  HH_pz = H1_pz + H2_pz
-  HH_E = H1_E + H2_E
-
-  df["reco_Mggtau"] = np.sqrt(HH_E**2 - HH_px**2 - HH_py**2 - HH_pz**2)
-  df["reco_Mggtau_mgg"] = df["reco_Mggtau"] / df["Diphoton_mass"]
-  df["reco_Mggtau_mgg2"] = df["reco_Mggtau"] - df["Diphoton_mass"]
-
-
-def add_Mggt_met1(df):
-  H1_px = df.Diphoton_pt * np.cos(df.Diphoton_phi)
-  H1_py = df.Diphoton_pt * np.sin(df.Diphoton_phi)
-  H1_pz = df.Diphoton_pt * np.sinh(df.Diphoton_eta)
-  H1_P = df.Diphoton_pt * np.cosh(df.Diphoton_eta)
-  H1_E = np.sqrt(H1_P**2 + df.Diphoton_mass**2)
-
-  H2_px = df.lead_lepton_pt * np.cos(df.lead_lepton_phi)
-  H2_py = df.lead_lepton_pt * np.sin(df.lead_lepton_phi)
-  H2_pz = df.lead_lepton_pt * np.sinh(df.lead_lepton_eta)
-  H2_P = df.lead_lepton_pt * np.cosh(df.lead_lepton_eta)
-  H2_E = np.sqrt(H2_P**2 + df.lead_lepton_mass**2)
-
-  MET_px = df.MET_pt * np.cos(df.MET_phi)
-  MET_py = df.MET_pt * np.sin(df.MET_phi)
-  MET_pz = 0
-  MET_E = np.sqrt(MET_px**2 + MET_py**2)
-
-  HH_px = H1_px + H2_px + MET_px
-  HH_py = H1_py + H2_py + MET_py
-  HH_pz = H1_pz + H2_pz + MET_pz
-  HH_E = H1_E + H2_E + MET_E
-
-  df["reco_MggtauMET"] = np.sqrt(HH_E**2 - HH_px**2 - HH_py**2 - HH_pz**2)
-  df["reco_MggtauMET_mgg"] = df["reco_MggtauMET"] / df["Diphoton_mass"]
+def add_reco_MX_met4(df, p4=None):
+  if p4 is None: p4 = FourVectors(df)
+  H1_px, H1_py, H1_pz, H1_E = p4["Diphoton"]
+  tau_px, tau_py, tau_pz, tau_E = p4["ditau"]
+  MET_px, MET_py, MET_pz, MET_E = p4["MET"]
+
+  H2_px = tau_px + MET_px
+  H2_py = tau_py + MET_py
+  H2_pz = tau_pz * 2
+  H2_E = np.sqrt(H2_px**2 + H2_py**2 + H2_pz**2 + p4.column("ditau_mass")**2)
+
+  reco_MX_MET = invariantMass(H1_px+H2_px, H1_py+H2_py, H1_pz+H2_pz, H1_E+H2_E)
+  reco_MX_MET_mgg = reco_MX_MET / p4.mgg()
+
+  single_lepton = p4.singleLepton()
+  df["reco_MX_MET"] = np.where(single_lepton, np.float32(common.dummy_val), reco_MX_MET)
+  df["reco_MX_MET_mgg"] = np.where(single_lepton, np.float32(common.dummy_val), reco_MX_MET_mgg)
+
+def add_Mggt(df, p4=None):
+  if p4 is None: p4 = FourVectors(df)
+  H1_px, H1_py, H1_pz, H1_E = p4["Diphoton"]
+  H2_px, H2_py, H2_pz, H2_E = p4["lead_lepton"]
+
+  reco_Mggtau = invariantMass(H1_px+H2_px, H1_py+H2_py, H1_pz+H2_pz, H1_E+H2_E)
+
+  df["reco_Mggtau"] = reco_Mggtau
+  df["reco_Mggtau_mgg"] = reco_Mggtau / p4.mgg()
+  df["reco_Mggtau_mgg2"] = reco_Mggtau - p4.mgg()
+
+def add_Mggt_met1(df, p4=None):
+  if p4 is None: p4 = FourVectors(df)
+  H1_px, H1_py, H1_pz, H1_E = p4["Diphoton"]
+  H2_px, H2_py, H2_pz, H2_E = p4["lead_lepton"]
+  MET_px, MET_py, MET_pz, MET_E = p4["MET"]
+
+  reco_MggtauMET = invariantMass(H1_px+H2_px+MET_px, H1_py+H2_py+MET_py, H1_pz+H2_pz+MET_pz, H1_E+H2_E+MET_E)
+
+  df["reco_MggtauMET"] = reco_MggtauMET
+  df["reco_MggtauMET_mgg"] = reco_MggtauMET / p4.mgg()
+
+def add_reco_masses(df):
+  """Add all the reco mass variables, sharing one set of four-vectors between them"""
+  p4 = FourVectors(df)
+  add_reco_MX(df, p4)
+  add_reco_MX_met4(df, p4)
+  add_Mggt(df, p4)
+  add_Mggt_met1(df, p4)
 
 # def add_Mggt_met2(df):
 #   H1_px = df.Diphoton_pt * np.cos(df.Diphoton_phi)
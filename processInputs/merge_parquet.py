@@ -1,11 +1,25 @@
-import pandas as pd
+"""
+Concatenate parquet files that share the same summary json (process ids are left untouched).
+Usage: python merge_parquet.py output.parquet input1.parquet input2.parquet ...
+Add --partitioned to write output.parquet as a directory partitioned by year and process_id.
+Subsample tiers (see dataset_tiers.py) among the inputs are skipped so that their events are not counted twice.
+"""
+
 import sys
-from tqdm import tqdm
+import preprocessing_cache
+import event_index
+import parquet_loader
+from combine_parquet import streamMerge
+
+argv = [arg for arg in sys.argv[1:] if arg != "--partitioned"]
+partitioned = "--partitioned" in sys.argv
+
+for path in filter(parquet_loader.isTierPath, argv[1:]):
+  print("Skipping subsample tier %s"%path)
+argv = argv[:1] + [path for path in argv[1:] if not parquet_loader.isTierPath(path)]
 
-dfs = []
-for f in tqdm(sys.argv[2:]):
-  dfs.append(pd.read_parquet(f))
-df = pd.concat(dfs)
+for path, reason in preprocessing_cache.checkOutputs(argv[1:]):
+  print("Warning: %s is out of date: %s"%(path, reason))
 
-#df = pd.concat([pd.read_parquet(f) for f in sys.argv[2:]])
-df.to_parquet(sys.argv[1])
+streamMerge(argv[1:], argv[0], partitioned=partitioned)
+event_index.writeIndex(argv[0])
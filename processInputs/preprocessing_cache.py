@@ -0,0 +1,118 @@
+"""
+Bookkeeping to avoid re-running process_HiggsDNA_Inputs.py over inputs that have not changed.
+
+Every output is keyed by a hash of
+  - the input parquet file's metadata (size and parquet footer),
+  - the summary json,
+  - the columns selected by --keep-features and --no-systematic-weights,
+  - the source of the feature-derivation code.
+The keys are stored in a manifest (preprocessing_manifest.json) in the same directory as the outputs.
+An output is only reprocessed if its key changes, and the merging scripts can use the manifest
+to check that the files they are given are up to date.
+"""
+
+import os
+import json
+import hashlib
+import fcntl
+import functools
+import common
+import parquet_loader
+import event_index
+import dataset_tiers
+
+manifest_name = "preprocessing_manifest.json"
+
+#source files whose contents determine the derived features
+feature_code = [
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), "process_HiggsDNA_Inputs.py"),
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), "derived_features.py"),
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), "mass_variables.py"),
+  os.path.join(os.path.dirname(os.path.abspath(__file__)), "angular_kernels.py"),
+  os.path.abspath(common.__file__),
+  os.path.abspath(parquet_loader.__file__), #the preselection
+  os.path.abspath(event_index.__file__), #the index written next to each output
+  os.path.abspath(dataset_tiers.__file__) #tiers written with --tiers
+]
+
+@functools.lru_cache()
+def codeVersion():
+  h = hashlib.sha256()
+  for path in feature_code:
+    with open(path, "rb") as f:
+      h.update(f.read())
+  return h.hexdigest()
+
+def inputKey(parquet_input, summary_input, keep_features, systematic_weights=True):
+  h = hashlib.sha256()
+  h.update(str(os.path.getsize(parquet_input)).encode())
+  h.update(parquet_loader.footerBytes(parquet_input))
+  with open(summary_input, "rb") as f:
+    h.update(f.read())
+  if keep_features != None:
+    h.update(json.dumps([keep_features] + common.train_features[keep_features]).encode())
+  if not systematic_weights:
+    h.update(b"no_systematic_weights")
+  h.update(codeVersion().encode())
+  return h.hexdigest()
+
+def manifestPath(parquet_output):
+  return os.path.join(os.path.dirname(os.path.abspath(parquet_output)), manifest_name)
+
+def loadManifest(parquet_output):
+  path = manifestPath(parquet_output)
+  if not os.path.exists(path): return {}
+  with open(path, "r") as f:
+    return json.load(f)
+
+def isUpToDate(parquet_output, key):
+  """True if parquet_output exists, has not been touched since it was recorded and was made from inputs with this key"""
+  entry = loadManifest(parquet_output).get(os.path.basename(parquet_output))
+  if (entry == None) or (entry["key"] != key): return False
+  if not os.path.exists(parquet_output): return False
+  stat = os.stat(parquet_output)
+  return (stat.st_size == entry["output_size"]) and (stat.st_mtime_ns == entry["output_mtime_ns"])
+
+def recordOutput(parquet_output, parquet_input, summary_input, keep_features, systematic_weights=True, key=None):
+  """Add an entry for a newly written output. The manifest is locked so that parallel jobs can update it safely."""
+  if key == None: key = inputKey(parquet_input, summary_input, keep_features, systematic_weights)
+  stat = os.stat(parquet_output)
+  entry = {
+    "key": key,
+    "input": os.path.abspath(parquet_input),
+    "summary": os.path.abspath(summary_input),
+    "keep_features": keep_features,
+    "systematic_weights": systematic_weights,
+    "output_size": stat.st_size,
+    "output_mtime_ns": stat.st_mtime_ns
+  }
+
+  path = manifestPath(parquet_output)
+  with open(path + ".lock", "w") as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    manifest = loadManifest(parquet_output)
+    manifest[os.path.basename(parquet_output)] = entry
+    with open(path + ".tmp", "w") as f:
+      json.dump(manifest, f, indent=4)
+    os.replace(path + ".tmp", path)
+    fcntl.flock(lock, fcntl.LOCK_UN)
+
+def checkOutputs(parquet_paths):
+  """
+  Check files that are about to be merged against their manifests.
+  Returns a list of (path, reason) for every file that is out of date. Files in directories
+  without a manifest were not made by process_HiggsDNA_Inputs.py and are not checked.
+  """
+  stale = []
+  for path in parquet_paths:
+    if not os.path.exists(manifestPath(path)): continue
+    entry = loadManifest(path).get(os.path.basename(path))
+    if entry == None:
+      stale.append((path, "not in manifest"))
+    elif not isUpToDate(path, entry["key"]):
+      stale.append((path, "modified since it was produced"))
+    elif not (os.path.exists(entry["input"]) and os.path.exists(entry["summary"])):
+      stale.append((path, "input no longer exists"))
+    elif inputKey(entry["input"], entry["summary"], entry["keep_features"], entry.get("systematic_weights", True)) != entry["key"]:
+      stale.append((path, "input or feature code has changed"))
+  return stale
@@ -1,59 +1,25 @@
 import pandas as pd
 import argparse
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
 import json
 import common
-import mass_variables
+import derived_features
+import preprocessing_cache
+import event_index
+import parquet_loader
+import dataset_tiers
 import sys
 
-dphi = lambda x, y: abs(x-y) - 2*(abs(x-y) - np.pi) * (abs(x-y) // np.pi)
-
 # def divide_pt_by_mgg(df):
 #   pt_columns = ["Diphoton_pt", "LeadPhoton_pt", "SubleadPhoton_pt"]
 #   for column in pt_columns:
 #     df.loc[:, column] /= df.Diphoton_mass
 #     df.rename({column:column+"_mgg"}, axis=1, inplace=True)
 
-def add_Deltas(df):
-  df["Diphoton_deta"] = df.LeadPhoton_eta-df.SubleadPhoton_eta
-  #df["Diphoton_dphi"] = dphi(df.LeadPhoton_phi, df.SubleadPhoton_phi)
-  df["Diphoton_dR"] = np.sqrt( dphi(df.LeadPhoton_phi, df.SubleadPhoton_phi)**2 + (df.LeadPhoton_eta-df.SubleadPhoton_eta)**2 )
-
-  df["ditau_deta"] = df.lead_lepton_eta - df.sublead_lepton_eta
-  #df["ditau_dphi"] = dphi(df.lead_lepton_phi,df.sublead_lepton_phi)
-  df.loc[df.category==8, "ditau_deta"] = common.dummy_val
-  df.loc[df.category==8, "ditau_dphi"] = common.dummy_val
-
-  df["Diphoton_lead_lepton_deta"] = df.Diphoton_eta-df.lead_lepton_eta
-  df["Diphoton_lead_lepton_dphi"] = dphi(df.Diphoton_phi,df.lead_lepton_phi)
-  df["Diphoton_lead_lepton_dR"] = np.sqrt( dphi(df.Diphoton_phi,df.lead_lepton_phi)**2 + (df.Diphoton_eta-df.lead_lepton_eta)**2 )
-
-  df["Diphoton_sublead_lepton_deta"] = df.Diphoton_eta-df.sublead_lepton_eta
-  df["Diphoton_sublead_lepton_dphi"] = dphi(df.Diphoton_phi,df.sublead_lepton_phi)
-  df["Diphoton_sublead_lepton_dR"] = np.sqrt( dphi(df.Diphoton_phi,df.sublead_lepton_phi)**2 + (df.Diphoton_eta-df.sublead_lepton_eta)**2 )
-  df.loc[df.category==8, "Diphoton_sublead_lepton_deta"] = common.dummy_val
-  df.loc[df.category==8, "Diphoton_sublead_lepton_dphi"] = common.dummy_val
-  df.loc[df.category==8, "Diphoton_sublead_lepton_dR"] = common.dummy_val
-
-  df["Diphoton_ditau_deta"] = df.Diphoton_eta-df.ditau_eta
-  df["Diphoton_ditau_dphi"] = dphi(df.Diphoton_phi,df.ditau_phi)
-  df["Diphoton_ditau_dR"] = np.sqrt( dphi(df.Diphoton_phi,df.ditau_phi)**2 + (df.Diphoton_eta-df.ditau_eta)**2 )
-  df.loc[df.category==8, "Diphoton_ditau_deta"] = common.dummy_val
-  df.loc[df.category==8, "Diphoton_ditau_dphi"] = common.dummy_val
-  df.loc[df.category==8, "Diphoton_ditau_dR"] = common.dummy_val
-
-  #zgamma variables
-  df["LeadPhoton_ditau_dR"] = np.sqrt( dphi(df.LeadPhoton_phi,df.ditau_phi)**2 + (df.LeadPhoton_eta-df.ditau_eta)**2 )
-  df["SubleadPhoton_ditau_dR"] = np.sqrt( dphi(df.SubleadPhoton_phi,df.ditau_phi)**2 + (df.SubleadPhoton_eta-df.ditau_eta)**2 )
-  df["LeadPhoton_lead_lepton_dR"] = np.sqrt( dphi(df.LeadPhoton_phi,df.lead_lepton_phi)**2 + (df.LeadPhoton_eta-df.lead_lepton_eta)**2 )
-  df["SubleadPhoton_lead_lepton_dR"] = np.sqrt( dphi(df.SubleadPhoton_phi,df.lead_lepton_phi)**2 + (df.SubleadPhoton_eta-df.lead_lepton_eta)**2 )
-  df["LeadPhoton_sublead_lepton_dR"] = np.sqrt( dphi(df.LeadPhoton_phi,df.sublead_lepton_phi)**2 + (df.LeadPhoton_eta-df.sublead_lepton_eta)**2 )
-  df["SubleadPhoton_sublead_lepton_dR"] = np.sqrt( dphi(df.SubleadPhoton_phi,df.sublead_lepton_phi)**2 + (df.SubleadPhoton_eta-df.sublead_lepton_eta)**2 )
-  df.loc[df.category==8, "LeadPhoton_ditau_dR"] = common.dummy_val
-  df.loc[df.category==8, "SubleadPhoton_ditau_dR"] = common.dummy_val
-  df.loc[df.category==8, "LeadPhoton_sublead_lepton_dR"] = common.dummy_val
-  df.loc[df.category==8, "SubleadPhoton_sublead_lepton_dR"] = common.dummy_val
-
 # def add_helicity_angles(df):
 #   import vector
 #   Diphoton = vector.array({
@@ -100,124 +66,211 @@ def add_Deltas(df):
 #   df.loc[df.category==8, "Diphoton_ditau_helicity_angle"] = common.dummy_val
 #   df.loc[df.category==8, "Diphoton_ditau_Colin_Soper"] = common.dummy_val
 
-def add_MET_variables(df):
- # met_dphi variables already exist for diphoton and lead_lepton
- df["ditau_met_dPhi"] = dphi(df.MET_phi, df.ditau_phi)
- df["sublead_lepton_met_dPhi"] = dphi(df.MET_phi, df.sublead_lepton_phi)
- df.loc[df.category==8, "sublead_lepton_met_dPhi"] = common.dummy_val
-
-def applyPixelVeto(df):
-  pixel_veto = (df.LeadPhoton_pixelSeed==0) & (df.SubleadPhoton_pixelSeed==0)
-  df.drop(df[~pixel_veto].index, inplace=True)
-
-def reduceMemory(df):
-  print(df.info())
-  for column in df.columns:
-    if df[column].dtype == "float64":
-      print("%s float64 -> float32"%column.ljust(50))
-      df.loc[:, column] = df[column].astype("float32")
-    elif df[column].dtype == "int64":
-      print("%s  int64 -> uint8"%column.ljust(50))
-      df.loc[:, column] = df[column].astype("uint8")
-    else:
-      print("%s %s -> %s"%(column.ljust(50), df[column].dtype, df[column].dtype))
-  print(df.info())
-
-def fixDtypes(df):
-  df.loc[:, "lead_lepton_id"] = df["lead_lepton_id"].astype("int8")
-  df.loc[:, "sublead_lepton_id"] = df["sublead_lepton_id"].astype("int8")
-  df.loc[:, "lead_lepton_charge"] = df["lead_lepton_charge"].astype("int8")
-  df.loc[:, "sublead_lepton_charge"] = df["sublead_lepton_charge"].astype("int8")
-  
-  df.loc[:, "process_id"] = df["process_id"].astype("uint8")
-  df.loc[:, "year"] = df["year"].astype("uint16")
-
-  df.loc[:, "LeadPhoton_pixelSeed"] = df["LeadPhoton_pixelSeed"].astype("uint8")
-  df.loc[:, "SubleadPhoton_pixelSeed"] = df["SubleadPhoton_pixelSeed"].astype("uint8")
-
-def checkNans(df):
-  for column in df.columns:
-    try:
-      if np.isnan(df[column]).any():
-        print(df.loc[np.isnan(df[column]), column])
-        df.loc[:, column].replace(np.nan, common.dummy_val, inplace=True)
-    except:
-      pass
-
-def checkInfs(df):
+#applied while scanning the input so that vetoed events are never converted to pandas
+preselection = {"pixel_veto": True}
+
+def scanInput(parquet_input, columns=None, batch_size=None):
+  """Record batches of (a subset of columns of) a parquet file passing the preselection. Row numbers in the input are not kept."""
+  dataset = ds.dataset(parquet_input, format="parquet")
+  kwargs = {} if batch_size == None else {"batch_size": batch_size}
+  return dataset.to_batches(columns=columns, filter=parquet_loader.preselectionFilter(dataset.schema, preselection), **kwargs)
+
+def castTable(table):
+  """
+  Cast an arrow table to the dtypes given by common.column_dtypes before it is converted to pandas,
+  so that a full precision (float64) dataframe never has to exist. Index columns are left alone.
+  """
+  pandas_metadata = table.schema.pandas_metadata
+  index_columns = [] if pandas_metadata == None else pandas_metadata["index_columns"]
+
+  fields = []
+  columns = []
+  for field, column in zip(table.schema, table.columns):
+    if pa.types.is_floating(field.type): kind = "f"
+    elif pa.types.is_integer(field.type): kind = "i"
+    else: kind = None
+    dtype = None if field.name in index_columns else common.columnDtype(field.name, kind)
+
+    if (field.name == "year") and (not pa.types.is_integer(field.type)):
+      #year is stored as a string, e.g. "2016UL_pre", in the HiggsDNA output
+      column = pc.utf8_slice_codeunits(column.cast(pa.string()), 0, 4)
+
+    if dtype != None:
+      column = column.cast(pa.from_numpy_dtype(np.dtype(dtype)), safe=False)
+    fields.append(pa.field(field.name, column.type))
+    columns.append(column)
+
+  return pa.Table.from_arrays(columns, schema=pa.schema(fields, metadata=table.schema.metadata))
+
+def projectSchema(schema, columns=None):
+  """Arrow schema of the given subset of columns (all columns if None), keeping the pandas metadata"""
+  if columns == None: return schema
+  return pa.schema([schema.field(column) for column in columns], metadata=schema.metadata)
+
+def readTable(parquet_input, columns=None):
+  """Read (a subset of columns of) a parquet file with the preselection and castTable applied one record batch at a time"""
+  pf = pq.ParquetFile(parquet_input)
+  schema = projectSchema(pf.schema_arrow, columns)
+  tables = [castTable(pa.Table.from_batches([batch], schema=schema)) for batch in scanInput(parquet_input, columns)]
+  if len(tables) == 0:
+    return castTable(projectSchema(pf.schema_arrow, columns).empty_table())
+  return pa.concat_tables(tables)
+
+def applyColumnDtypes(df):
+  """Cast columns added during processing (e.g. MX, MY and the derived features) to their storage dtype"""
   for column in df.columns:
-    try:
-      if np.isinf(df[column]).any():
-        print(df.loc[np.isinf(df[column]), column])
-        df.drop(df.loc[np.isinf(df[column])].index, inplace=True)    
-    except:
-      pass  
-
-def merge2016(df):
-  df.loc[df.year==b"2016UL_pre", "year"] = "2016"
-  df.loc[df.year==b"2016UL_pos", "year"] = "2016"
-
-def add_ditau_phi(df):
-  tau1_px = df.lead_lepton_pt * np.cos(df.lead_lepton_phi)
-  tau1_py = df.lead_lepton_pt * np.sin(df.lead_lepton_phi)
-  tau2_px = df.sublead_lepton_pt * np.cos(df.sublead_lepton_phi)
-  tau2_py = df.sublead_lepton_pt * np.sin(df.sublead_lepton_phi)
-
-  ditau_px = tau1_px + tau2_px
-  ditau_py = tau1_py + tau2_py
-  df["ditau_phi"] = np.arctan2(ditau_py, ditau_px)
-
-def dividePhotonPT(df):
-  df["LeadPhoton_pt_mgg"] = df["LeadPhoton_pt"] / df["Diphoton_mass"]
-  df["SubleadPhoton_pt_mgg"] = df["SubleadPhoton_pt"] / df["Diphoton_mass"]
-
-def main(parquet_input, parquet_output, summary_input, do_test, keep_features):
-  if not do_test:
-    df = pd.read_parquet(parquet_input)
+    dtype = common.columnDtype(column, df[column].dtype.kind)
+    if (dtype != None) and (df[column].dtype != dtype):
+      df[column] = df[column].astype(dtype)
+
+def sanitise(df):
+  """
+  Replace NaNs with common.dummy_val and drop any events with an infinite value.
+  Each float column is checked once and the offending rows are dropped in a single operation.
+  Only the columns of df are checked, so reading fewer columns (--keep-features, --no-systematic-weights)
+  can keep events that have an infinite value in a column that was not read.
+  Returns the number of NaNs and infs found in each column.
+  """
+  counts = {}
+  bad_rows = np.zeros(len(df), dtype=bool)
+
+  for column in df.select_dtypes(include="floating").columns:
+    values = df[column].to_numpy()
+    finite = np.isfinite(values)
+    if finite.all(): continue
+
+    nans = np.isnan(values)
+    infs = ~(finite | nans)
+    counts[column] = {"nan": int(nans.sum()), "inf": int(infs.sum())}
+    print("%s %d NaNs, %d infs"%(column.ljust(50), counts[column]["nan"], counts[column]["inf"]))
+
+    if nans.any():
+      df[column] = np.where(nans, common.dummy_val, values).astype(values.dtype)
+    bad_rows |= infs
+
+  if bad_rows.any():
+    print("Dropping %d events with infinite values"%bad_rows.sum())
+    df.drop(df.index[bad_rows], inplace=True)
+
+  return counts
+
+def isSystematicWeight(column):
+  return ("weight" in column) and (column != "weight_central")
+
+def getKeepColumns(columns, keep_features, systematic_weights=True):
+  keep_columns = list(common.train_features[keep_features])
+  if systematic_weights:
+    keep_columns += list(filter(lambda x: "weight" in x, columns)) #add weights
   else:
-    from pyarrow.parquet import ParquetFile
-    import pyarrow as pa
-    pf = ParquetFile(parquet_input) 
-    iter = pf.iter_batches(batch_size = 10)
-    first_ten_rows = next(iter) 
-    df = pa.Table.from_batches([first_ten_rows]).to_pandas() 
-
+    keep_columns += ["weight_central"]
+  keep_columns += ["Diphoton_mass", "MX", "MY", "event", "year", "category", "process_id"] #add other neccessary columns
+  return list(dict.fromkeys(keep_columns)) #remove overlap in columns
+
+def getInputColumns(schema, keep_columns, systematic_weights=True):
+  """
+  Columns that need to be read from the input (with the given arrow schema) to produce keep_columns.
+  If keep_columns is None every column is read (None), apart from the systematic weights if systematic_weights is False.
+  """
+  if keep_columns == None:
+    if systematic_weights: return None
+    return [column for column in schema.names if not isSystematicWeight(column)]
+
+  needed = derived_features.inputColumns(keep_columns)
+  needed += ["process_id"] #for add_MX_MY, the pixel seeds are only needed by the preselection which reads them itself
+  pandas_metadata = schema.pandas_metadata
+  if pandas_metadata != None: #stored index
+    needed += [column for column in pandas_metadata["index_columns"] if isinstance(column, str)]
+
+  return [column for column in schema.names if column in set(needed)]
+
+def processDataFrame(df, proc_dict, keep_columns=None):
   original_columns = list(df.columns)
 
-  checkNans(df)
-  checkInfs(df)
-
-  with open(summary_input, "r") as f:
-    proc_dict = json.load(f)["sample_id_map"]
+  sanitise(df)
 
   common.add_MX_MY(df, proc_dict)
 
-  applyPixelVeto(df)
-
-  add_ditau_phi(df)
-  add_MET_variables(df)
-  add_Deltas(df)
-  dividePhotonPT(df)
-  mass_variables.add_reco_MX(df)  
-  mass_variables.add_reco_MX_met4(df)
-  mass_variables.add_Mggt(df)
-  mass_variables.add_Mggt_met1(df)
+  #only compute the derived features needed for the kept columns
+  derived_features.addFeatures(df, keep_columns)
   #add_helicity_angles(df)
   #divide_pt_by_mgg(df)
-  merge2016(df)
 
-  fixDtypes(df)
-  reduceMemory(df)
+  applyColumnDtypes(df)
+  print(df.info())
 
   print("Additional columns:")
   print(set(df.columns).difference(original_columns))
 
+  if keep_columns != None:
+    df = df[keep_columns]
+
+  return df
+
+def processStreaming(parquet_input, parquet_output, proc_dict, keep_features, batch_size, systematic_weights=True):
+  """
+  Process the input one record batch at a time and append each processed batch to the output.
+  Every step in processDataFrame acts row by row so the output content is the same as
+  processing the whole file at once, but peak memory is set by batch_size.
+  Events failing the preselection are dropped by scanInput before they are read, so (as in main) a
+  RangeIndex of the output counts the events passing the preselection, 0 to n-1 with gaps only where
+  sanitise dropped events, and is not the row number of the event in the input file.
+  """
+  pf = pq.ParquetFile(parquet_input)
+  keep_columns = None
   if keep_features != None:
-    keep_features = common.train_features[keep_features]
-    keep_features += list(filter(lambda x: "weight" in x, df.columns)) #add weights
-    keep_features += ["Diphton_mass", "MX", "MY", "event", "year", "category", "process_id"] #add other neccessary columns
-    keep_features = list(set(keep_features)) #remove overlap in columns
-    df = df[keep_features]
+    keep_columns = getKeepColumns(pf.schema_arrow.names, keep_features, systematic_weights)
+  input_columns = getInputColumns(pf.schema_arrow, keep_columns, systematic_weights)
+  schema = projectSchema(pf.schema_arrow, input_columns)
+
+  writer = None
+  offset = 0
+  for batch in scanInput(parquet_input, input_columns, batch_size):
+    if batch.num_rows == 0: continue #every event in the batch failed the preselection
+    df = castTable(pa.Table.from_batches([batch], schema=schema)).to_pandas()
+    if isinstance(df.index, pd.RangeIndex): #keep index consistent with reading the whole file at once
+      df.index = pd.RangeIndex(offset, offset+len(df))
+    offset += len(df)
+
+    df = processDataFrame(df, proc_dict, keep_columns)
+
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    if writer == None:
+      writer = pq.ParquetWriter(parquet_output, table.schema)
+    writer.write_table(table)
+
+  if writer == None: #empty input, still want an output with the right columns
+    df = castTable(schema.empty_table()).to_pandas()
+    df = processDataFrame(df, proc_dict, keep_columns)
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    writer = pq.ParquetWriter(parquet_output, table.schema)
+    writer.write_table(table)
+  writer.close()
+
+  print("Final columns:")
+  print(writer.schema.names)
+
+def main(parquet_input, parquet_output, summary_input, do_test, keep_features, batch_size=None, systematic_weights=True):
+  with open(summary_input, "r") as f:
+    proc_dict = json.load(f)["sample_id_map"]
+
+  if (batch_size != None) and (not do_test):
+    return processStreaming(parquet_input, parquet_output, proc_dict, keep_features, batch_size, systematic_weights)
+
+  #only read the columns needed to make the kept columns
+  pf = pq.ParquetFile(parquet_input)
+  keep_columns = None
+  if keep_features != None:
+    keep_columns = getKeepColumns(pf.schema_arrow.names, keep_features, systematic_weights)
+  input_columns = getInputColumns(pf.schema_arrow, keep_columns, systematic_weights)
+
+  if not do_test:
+    #self_destruct frees the arrow memory as each column is converted
+    df = readTable(parquet_input, input_columns).to_pandas(split_blocks=True, self_destruct=True)
+  else:
+    first_ten_rows = ds.dataset(parquet_input, format="parquet").head(10, columns=input_columns, filter=parquet_loader.preselectionFilter(pf.schema_arrow, preselection))
+    df = castTable(first_ten_rows).to_pandas()
+
+  df = processDataFrame(df, proc_dict, keep_columns)
 
   print("Final columns:")
   print(df.columns)
@@ -225,18 +278,29 @@ def main(parquet_input, parquet_output, summary_input, do_test, keep_features):
   df.to_parquet(parquet_output)
   return df
 
-if __name__=="__main__":
+def getParser():
   parser = argparse.ArgumentParser()
   parser.add_argument('--parquet-input', '-i', type=str, required=True)
   parser.add_argument('--parquet-output', '-o', type=str, required=True)
   parser.add_argument('--summary-input', '-s', type=str, required=True)
   parser.add_argument('--test', action="store_true", default=False)
-  parser.add_argument('--keep-features', '-f', type=str, default=None)
+  parser.add_argument('--keep-features', '-f', type=str, default=None, help="Only keep these training features (a key of common.train_features). Only the input columns they need are read and checked for NaNs and infs, so events with an inf in another column are kept rather than dropped.")
+  parser.add_argument('--no-systematic-weights', action="store_true", help="Only keep weight_central and not the systematic weight_* columns. These columns are then not read or checked for infs either.")
+  parser.add_argument('--stream-batch-size', type=int, default=None, help="Process the input in record batches of this many rows instead of loading the whole file. Limits memory usage.")
+  parser.add_argument('--tiers', type=float, nargs="+", default=None, help="Also write stratified subsample tiers of the output with these fractions of events, e.g. 0.01 0.1 (see dataset_tiers.py).")
   parser.add_argument('--batch', action="store_true")
+  return parser
 
-  args = parser.parse_args()
+if __name__=="__main__":
+  #every option is a store_true flag or takes a value so that common.parserToList can rebuild the command line
+  args = getParser().parse_args()
 
   if args.batch:
     common.submitToBatch([sys.argv[0]] + common.parserToList(args))
   else:
-    main(args.parquet_input, args.parquet_output, args.summary_input, args.test, args.keep_features)
\ No newline at end of file
+    main(args.parquet_input, args.parquet_output, args.summary_input, args.test, args.keep_features, args.stream_batch_size, not args.no_systematic_weights)
+    if not args.test:
+      event_index.writeIndex(args.parquet_output)
+      if args.tiers != None:
+        dataset_tiers.writeTiers(args.parquet_output, args.tiers)
+      preprocessing_cache.recordOutput(args.parquet_output, args.parquet_input, args.summary_input, args.keep_features, not args.no_systematic_weights)
\ No newline at end of file
@@ -1,6 +1,69 @@
 import argparse
 import os
+import contextlib
+import traceback
+import resource
+import multiprocessing
+from tqdm import tqdm
 import common
+import preprocessing_cache
+import event_index
+
+def isValidOutput(path):
+  """An output is valid if it exists and its parquet footer can be read (i.e. it was completely written)"""
+  if not os.path.exists(path): return False
+  try:
+    import pyarrow.parquet as pq
+    pq.ParquetFile(path).metadata
+    return True
+  except Exception:
+    return False
+
+def limitMemory(max_memory):
+  """Cap the address space of a worker (in GB) so a single file cannot take the whole node down"""
+  if max_memory != None:
+    limit = int(max_memory * 1024**3)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+def processFile(job):
+  """
+  Process a single file inside a worker. Output is written to a temporary file and only moved
+  into place once complete so that an interrupted job never leaves a valid-looking output.
+  Stdout of the processing goes to <output>.log.
+  """
+  import process_HiggsDNA_Inputs
+  parquet_input, parquet_output, summary_input, keep_features, batch_size, systematic_weights = job
+  tmp_output = parquet_output + ".tmp"
+  try:
+    with open(parquet_output + ".log", "w") as log, contextlib.redirect_stdout(log):
+      process_HiggsDNA_Inputs.main(parquet_input, tmp_output, summary_input, False, keep_features, batch_size, systematic_weights)
+    os.replace(tmp_output, parquet_output)
+    event_index.writeIndex(parquet_output)
+    preprocessing_cache.recordOutput(parquet_output, parquet_input, summary_input, keep_features, systematic_weights)
+    return job, None
+  except Exception:
+    if os.path.exists(tmp_output): os.remove(tmp_output)
+    return job, traceback.format_exc()
+
+def runLocal(jobs, n_workers, max_memory, retries):
+  """Process jobs in a pool of n_workers, retrying failed files up to retries times. Returns the jobs that never succeeded."""
+  failed = jobs
+  with tqdm(total=len(jobs), desc="Processing files") as pbar:
+    for attempt in range(retries+1):
+      if len(failed) == 0: break
+      if attempt > 0: print(">> Retrying %d failed files (attempt %d)"%(len(failed), attempt+1))
+
+      to_run, failed = failed, []
+      #maxtasksperchild=1 gives every file a fresh worker so memory is returned to the system between files
+      with multiprocessing.Pool(min(n_workers, len(to_run)), initializer=limitMemory, initargs=(max_memory,), maxtasksperchild=1) as pool:
+        for job, error in pool.imap_unordered(processFile, to_run):
+          if error == None:
+            pbar.update(1)
+          else:
+            failed.append(job)
+            tqdm.write("Failed to process %s\n%s"%(job[0], error))
+          pbar.set_postfix(failed=len(failed))
+  return failed
 
 if __name__=="__main__":
   parser = argparse.ArgumentParser()
@@ -8,12 +71,42 @@ if __name__=="__main__":
   parser.add_argument('--output-dir', '-o', type=str, required=True)
   parser.add_argument('--folders', type=str, nargs="+", required=True)
   parser.add_argument('--keep-features', '-f', type=str, default=None)
+  parser.add_argument('--no-systematic-weights', action="store_true", help="Passed on to process_HiggsDNA_Inputs.py. Only keep weight_central.")
+  parser.add_argument('--stream-batch-size', type=int, default=None, help="Passed on to process_HiggsDNA_Inputs.py. Process each file in record batches of this many rows.")
+  parser.add_argument('--local-workers', type=int, default=0, help="Process files with this many local processes instead of submitting to the batch system.")
+  parser.add_argument('--worker-memory', type=float, default=24, help="Memory limit (GB) for each local worker.")
+  parser.add_argument('--retries', type=int, default=2, help="Number of times to retry a file that failed when running locally.")
+  parser.add_argument('--force', action="store_true", help="Reprocess files even if an up to date output already exists.")
 
   args = parser.parse_args()
 
+  jobs = []
+  n_skipped = 0
   for folder in args.folders:
     os.makedirs(os.path.join(args.output_dir, folder), exist_ok=True)
     files = os.listdir(os.path.join(args.input_dir, folder))
     for f in files:
-      options = "-i %s/%s/%s -o %s/%s/%s -s %s/summary.json -f %s --batch"%(args.input_dir,folder,f,  args.output_dir,folder,f,  args.input_dir,  args.keep_features)
-      common.submitToBatch(["processInputs/process_HiggsDNA_Inputs.py"] + options.split(" "))
\ No newline at end of file
+      parquet_input = os.path.join(args.input_dir, folder, f)
+      parquet_output = os.path.join(args.output_dir, folder, f)
+      summary_input = os.path.join(args.input_dir, "summary.json")
+      #skip if the output was made from the same input, summary, feature selection and code
+      key = preprocessing_cache.inputKey(parquet_input, summary_input, args.keep_features, not args.no_systematic_weights)
+      if (not args.force) and preprocessing_cache.isUpToDate(parquet_output, key) and isValidOutput(parquet_output):
+        n_skipped += 1
+        continue
+      jobs.append((parquet_input, parquet_output, summary_input, args.keep_features, args.stream_batch_size, not args.no_systematic_weights))
+  print(">> %d files to process, %d skipped (up to date)"%(len(jobs), n_skipped))
+
+  if args.local_workers > 0:
+    failed = runLocal(jobs, args.local_workers, args.worker_memory, args.retries)
+    if len(failed) > 0:
+      print(">> Failed to process:")
+      print("\n".join([job[0] for job in failed]))
+      exit(1)
+  else:
+    for parquet_input, parquet_output, summary_input, keep_features, batch_size, systematic_weights in jobs:
+      options = "-i %s -o %s -s %s --batch"%(parquet_input, parquet_output, summary_input)
+      if keep_features != None: options += " -f %s"%keep_features
+      if batch_size != None: options += " --stream-batch-size %d"%batch_size
+      if not systematic_weights: options += " --no-systematic-weights"
+      common.submitToBatch(["processInputs/process_HiggsDNA_Inputs.py"] + options.split(" "))
@@ -0,0 +1,19 @@
+import common
+import process_HiggsDNA_Inputs
+
+def roundTrip(argv):
+  """Parse argv, rebuild the command line with common.parserToList (as --batch does) and parse it again"""
+  parser = process_HiggsDNA_Inputs.getParser()
+  args = parser.parse_args(argv)
+  return vars(args), vars(parser.parse_args(common.parserToList(args)))
+
+def test_parserToList_defaults():
+  args, resubmitted = roundTrip(["-i", "in.parquet", "-o", "out.parquet", "-s", "summary.json", "--batch"])
+  assert resubmitted == args
+
+def test_parserToList_options():
+  argv = ["-i", "in.parquet", "-o", "out.parquet", "-s", "summary.json", "-f", "all", "--no-systematic-weights",
+          "--stream-batch-size", "1000", "--tiers", "0.01", "0.1", "--batch"]
+  args, resubmitted = roundTrip(argv)
+  assert resubmitted == args
+  assert resubmitted["no_systematic_weights"]
@@ -15,6 +15,7 @@ import argparse
 import os
 import json
 import common
+import parquet_loader
 
 mplhep.set_style("CMS")
 plt.rcParams["figure.figsize"] = (12.5,10)
@@ -154,10 +155,11 @@ def tagSignals(df, optim_dir, proc_dict):
   return df[df.SR!=-1]
 
 def main(args):
-  df = pd.read_parquet(args.parquet_input)
-  df = df[df.y==1]
   with open(args.summary_input) as f:
     proc_dict = json.load(f)['sample_id_map']
+  sig_ids = [proc_dict[proc] for proc in common.sig_procs["all"] if proc in proc_dict.keys()]
+  df = parquet_loader.readDataFrame(args.parquet_input, process_ids=sig_ids) #only read signal
+  df = df[df.y==1]
   common.add_MX_MY(df, proc_dict)
   print(np.unique(df.MX))
 
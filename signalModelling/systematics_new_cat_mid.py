@@ -9,6 +9,7 @@ import argparse
 import os
 import json
 import common
+import systematic_delta
 import sys
 
 import tracemalloc
@@ -291,8 +292,9 @@ def tagSignals(df, optim_dir, proc_dict):
   return df[df.SR!=-1]
 
 def loadDataFrame(path, proc_dict, optim_dir, columns=None, batch_size=None):
+  sig_ids = [proc_dict[proc] for proc in common.sig_procs["all"] if proc in proc_dict.keys()]
   if batch_size is None:
-    df = pd.read_parquet(path, columns=columns)
+    df = systematic_delta.loadDataFrame(path, columns=columns, process_ids=sig_ids) #only read signal, full or delta encoded
   else:
     from pyarrow.parquet import ParquetFile
     import pyarrow as pa
@@ -324,14 +326,11 @@ def loadDataFrames(args):
 
   tracemalloc.start()
 
-  for path in os.listdir(args.parquet_input):
-    #if (".parquet" in path) and ("nominal" not in path):
-    if "fnuf" in path:
+  for name, path in systematic_delta.listVariations(args.parquet_input).items():
+    if "fnuf" in name:
       print(path)
       print(np.array(tracemalloc.get_traced_memory())/(1024*1024*1024))
-      df = loadDataFrame(os.path.join(args.parquet_input, path), proc_dict, args.optim_dir, columns=systematic_columns, batch_size=batch_size)
-      name = "_".join(path.split(".parquet")[0].split("_")[1:])
-      dfs[name] = df
+      dfs[name] = loadDataFrame(path, proc_dict, args.optim_dir, columns=systematic_columns, batch_size=batch_size)
 
   tracemalloc.stop()
   print(dfs)
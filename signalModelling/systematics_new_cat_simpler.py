@@ -10,6 +10,7 @@ import argparse
 import os
 import json
 import common
+import systematic_delta
 
 from signalModelling.interpolate_new_cat_simpler import tagSignals
 
@@ -248,7 +249,8 @@ def addMigrationSystematics(outdir):
 
 def loadDataFrame(path, proc_dict, optim_dir, columns=None, batch_size=None):
   if batch_size is None:
-    df = pd.read_parquet(path, columns=columns)
+    sig_ids = [proc_dict[proc] for proc in common.sig_procs["all"] if proc in proc_dict.keys()]
+    df = systematic_delta.loadDataFrame(path, columns=columns, process_ids=sig_ids) #only read signal, full or delta encoded
   else:
     from pyarrow.parquet import ParquetFile
     import pyarrow as pa
@@ -273,12 +275,9 @@ def loadDataFrames(args):
   systematic_columns = list(filter(lambda x: ("intermediate_transformed_score" in x), df.columns)) + ["Diphoton_mass", "process_id", "weight", "y", "year"]
   dfs["nominal"] = df
 
-  # for path in os.listdir(args.parquet_input):
-  #   if (".parquet" in path) and ("nominal" not in path):
-  #     print(path)
-  #     df = loadDataFrame(os.path.join(args.parquet_input, path), proc_dict, optim_dir, columns=systematic_columns, batch_size=None)
-  #     name = "_".join(path.split(".parquet")[0].split("_")[1:])
-  #     dfs[name] = df
+  # for name, path in systematic_delta.listVariations(args.parquet_input).items():
+  #   print(path)
+  #   dfs[name] = loadDataFrame(path, proc_dict, args.optim_dir, columns=systematic_columns, batch_size=None)
   return dfs
 
 def main(args):
@@ -0,0 +1,186 @@
+"""
+Delta-encoded storage of systematic variations.
+
+Most variations (JER, JES, MET, fnuf, material, scale, smear...) change only a handful of columns
+of a few events compared to the nominal file. A variation merged_<syst>.parquet can be stored as a
+directory merged_<syst>.delta/ holding
+  changed.parquet  the event keys (see event_index.py) and values of the columns that differ, for the events where they differ
+  added.parquet    full rows of events that are only in the variation
+  removed.parquet  event keys of nominal events that are not in the variation
+  _delta.json      the nominal file it is relative to and the columns of the variation
+and loadVariation reconstructs it, reading only the requested columns of the nominal file.
+Consumers of the variations should read them with loadDataFrame, which takes either form.
+
+Usage: python systematic_delta.py -i Outputs/... [--nominal merged_nominal.parquet] [--remove-full]
+converts every merged_*.parquet in a directory except the nominal.
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import event_index
+import parquet_loader
+
+key_column = "_key"
+delta_file = "_delta.json"
+
+def isDelta(path):
+  return os.path.exists(os.path.join(path, delta_file))
+
+def deltaPath(path):
+  return path.split(".parquet")[0] + ".delta"
+
+def dataColumns(path):
+  """Columns of a parquet file excluding any stored pandas index"""
+  schema = parquet_loader.openDataset(path).schema
+  index_columns = [] if schema.pandas_metadata == None else schema.pandas_metadata["index_columns"]
+  return [column for column in schema.names if column not in index_columns]
+
+def readColumn(path, column):
+  return parquet_loader.readTable(path, columns=[column]).column(column).to_numpy()
+
+def differs(a, b):
+  """Element-wise a != b where two NaNs count as equal"""
+  different = a != b
+  if np.issubdtype(a.dtype, np.floating) and np.issubdtype(b.dtype, np.floating):
+    different &= ~(np.isnan(a) & np.isnan(b))
+  return different
+
+def encode(nominal_path, variation_path, output_path):
+  """Write variation_path as a delta relative to nominal_path. Both files need unique event keys."""
+  nominal_keys, nominal_rows = event_index.loadIndex(nominal_path)
+  variation_keys, variation_rows = event_index.loadIndex(variation_path)
+  for path, keys, rows in [(nominal_path, nominal_keys, nominal_rows), (variation_path, variation_keys, variation_rows)]:
+    if len(event_index.firstOccurrence(keys, rows)[0]) != len(keys):
+      raise ValueError("%s contains duplicated event keys and cannot be delta encoded"%path)
+
+  keys, (nominal_common, variation_common) = event_index.join([nominal_path, variation_path])
+
+  #find the columns that change and the events they change for, one column at a time
+  nominal_columns = set(dataColumns(nominal_path))
+  variation_columns = dataColumns(variation_path)
+  changed_columns = []
+  changed = np.zeros(len(keys), dtype=bool)
+  for column in variation_columns:
+    if column not in nominal_columns:
+      changed_columns.append(column)
+      changed[:] = True
+      continue
+    different = differs(readColumn(nominal_path, column)[nominal_common], readColumn(variation_path, column)[variation_common])
+    if different.any():
+      changed_columns.append(column)
+      changed |= different
+
+  os.makedirs(output_path, exist_ok=True)
+
+  table = parquet_loader.readTable(variation_path, columns=changed_columns).take(pa.array(variation_common[changed]))
+  table = pa.Table.from_arrays([pa.array(keys[changed])] + [table.column(column) for column in changed_columns], names=[key_column] + changed_columns)
+  pq.write_table(table, os.path.join(output_path, "changed.parquet"))
+
+  added = np.setdiff1d(variation_rows, variation_common)
+  table = parquet_loader.readTable(variation_path, columns=variation_columns).take(pa.array(added))
+  pq.write_table(table, os.path.join(output_path, "added.parquet"))
+
+  removed = np.setdiff1d(nominal_keys, keys, assume_unique=True)
+  pq.write_table(pa.table({key_column: removed}), os.path.join(output_path, "removed.parquet"))
+
+  info = {
+    "nominal": os.path.relpath(os.path.abspath(nominal_path), os.path.dirname(os.path.abspath(output_path))),
+    "columns": variation_columns,
+    "changed_columns": changed_columns
+  }
+  with open(os.path.join(output_path, delta_file), "w") as f:
+    json.dump(info, f, indent=4)
+
+  print("%s: %d columns changed for %d/%d events, %d added, %d removed"%(variation_path, len(changed_columns), changed.sum(), len(keys), len(added), len(removed)))
+
+def selectProcesses(keys, process_ids):
+  """Mask of the keys belonging to the given process ids (None means all)"""
+  if process_ids == None: return np.ones(len(keys), dtype=bool)
+  return np.isin(event_index.keyProcessIds(keys), np.asarray(process_ids, dtype=np.uint64))
+
+def loadVariation(path, columns=None, process_ids=None):
+  """
+  Dataframe of a delta encoded variation (or the given subset of its columns), rebuilt from the nominal file.
+  If process_ids is given, only the events of those processes are read.
+  """
+  with open(os.path.join(path, delta_file), "r") as f:
+    info = json.load(f)
+  nominal_path = os.path.join(os.path.dirname(os.path.abspath(path)), info["nominal"])
+
+  columns = info["columns"] if columns == None else [column for column in columns if column in info["columns"]]
+  changed_columns = [column for column in info["changed_columns"] if column in columns]
+  #changed columns are also read from the nominal file (if it has them) for the events that did not change
+  nominal_columns = [column for column in columns if column in set(dataColumns(nominal_path))]
+
+  df = parquet_loader.readTable(nominal_path, columns=nominal_columns, process_ids=process_ids).to_pandas().reset_index(drop=True)
+  keys, rows = event_index.loadIndex(nominal_path)
+  selected = selectProcesses(keys, process_ids)
+  #the selected rows keep their order in the filtered read, so their new row is their rank among the selected rows
+  keys, rows = keys[selected], np.searchsorted(np.sort(rows[selected]), rows[selected])
+
+  #overlay the changed columns onto the nominal rows
+  changed = pq.read_table(os.path.join(path, "changed.parquet"), columns=[key_column] + changed_columns).to_pandas()
+  changed = changed[selectProcesses(changed[key_column].to_numpy(), process_ids)]
+  changed_rows = rows[np.searchsorted(keys, changed[key_column].to_numpy())]
+  for column in changed_columns:
+    if column in df.columns: #cast to the dtype of the variation rather than letting the assignment cast silently
+      values = df[column].to_numpy().astype(changed[column].dtype, copy=True)
+    else: #only in the variation so every common event is in changed.parquet
+      values = np.empty(len(df), dtype=changed[column].dtype)
+    values[changed_rows] = changed[column].to_numpy()
+    df[column] = values
+
+  removed = pq.read_table(os.path.join(path, "removed.parquet")).column(key_column).to_numpy()
+  removed = removed[selectProcesses(removed, process_ids)]
+  keep = np.ones(len(df), dtype=bool)
+  keep[rows[np.searchsorted(keys, removed)]] = False
+  df = df[keep]
+
+  added = parquet_loader.readTable(os.path.join(path, "added.parquet"), columns=columns, process_ids=process_ids).to_pandas()
+  return pd.concat([df, added], ignore_index=True)[columns]
+
+def loadDataFrame(path, columns=None, process_ids=None):
+  """
+  Dataframe of a variation given as merged_<syst>.parquet or merged_<syst>.delta, whichever exists,
+  so that callers do not depend on whether the full file was removed after encoding.
+  """
+  if (not os.path.exists(path)) and isDelta(deltaPath(path)):
+    path = deltaPath(path)
+  if isDelta(path):
+    return loadVariation(path, columns=columns, process_ids=process_ids)
+  return parquet_loader.readDataFrame(path, columns=columns, process_ids=process_ids)
+
+def listVariations(directory):
+  """
+  {<syst>: path} of the variations merged_<syst>.parquet or merged_<syst>.delta in a directory, skipping the
+  nominal, tiers and index files. If a variation is stored in both forms the delta is used.
+  """
+  variations = {}
+  for name in sorted(os.listdir(directory)):
+    if not (name.endswith(".parquet") or name.endswith(".delta")): continue
+    if ("nominal" in name) or parquet_loader.isTierPath(name): continue
+    syst = "_".join(name.split(".parquet")[0].split(".delta")[0].split("_")[1:])
+    if (syst not in variations) or name.endswith(".delta"):
+      variations[syst] = os.path.join(directory, name)
+  return variations
+
+if __name__=="__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--input-dir', '-i', type=str, required=True)
+  parser.add_argument('--nominal', type=str, default="merged_nominal.parquet")
+  parser.add_argument('--remove-full', action="store_true", default=False, help="Delete each full variation file once it has been encoded.")
+  args = parser.parse_args()
+
+  nominal_path = os.path.join(args.input_dir, args.nominal)
+  for name in sorted(os.listdir(args.input_dir)):
+    path = os.path.join(args.input_dir, name)
+    if (not name.endswith(".parquet")) or (name == args.nominal) or parquet_loader.isTierPath(name): continue
+    encode(nominal_path, path, deltaPath(path))
+    if args.remove_full:
+      os.remove(path)
+      if os.path.exists(event_index.indexPath(path)): os.remove(event_index.indexPath(path))
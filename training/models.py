@@ -5,6 +5,7 @@ import pickle
 from tqdm import tqdm
 import random
 import os
+import json
 
 import matplotlib.pyplot as plt
 
@@ -29,6 +30,74 @@ def setSeed(seed):
   random.seed(seed)
   np.random.seed(seed)
 
+class InflatedArray:
+  """
+  Background rows repeated for every combination of parameters (masses) without copying X.
+  Row i is X[rows[i]] with its last n_params columns set to combinations[mass_ids[i]].
+  Indexing along the first axis (slice, integer or boolean array) returns a numpy array.
+  """
+  def __init__(self, X, rows, mass_ids, combinations):
+    self.X = X
+    self.rows = rows
+    self.mass_ids = mass_ids
+    self.combinations = combinations
+    self.n_params = combinations.shape[1]
+    self.shape = (len(rows), X.shape[1])
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __getitem__(self, idx):
+    X = self.X[self.rows[idx]]
+    X[:, -self.n_params:] = self.combinations[self.mass_ids[idx]]
+    return X
+
+  def copy(self):
+    return self[:]
+
+class StagedDataset:
+  """
+  Training arrays converted once to contiguous float32 tensors on dev so that batches are gathered with
+  index_select instead of being copied from numpy. If X is an InflatedArray only its X is staged and
+  the masses are attached to each gathered batch, along with mass_ids (the index of each row's combination
+  of masses, None for other inputs). Index views of the same InflatedArray base (e.g. the
+  training and validation sets) can share its staged copy by passing base, the X of another StagedDataset.
+  """
+  def __init__(self, X, y, w, base=None):
+    if isinstance(X, InflatedArray):
+      self.X = base if base is not None else torch.tensor(np.ascontiguousarray(X.X), dtype=torch.float).to(dev)
+      self.rows = torch.tensor(X.rows, dtype=torch.long).to(dev)
+      self.mass_ids = torch.tensor(X.mass_ids, dtype=torch.long).to(dev)
+      self.combinations = torch.tensor(X.combinations, dtype=torch.float).to(dev)
+      self.n_params = X.n_params
+    else:
+      self.X = torch.tensor(np.ascontiguousarray(X), dtype=torch.float).reshape(len(X), -1).to(dev)
+      self.rows = None
+      self.mass_ids = None
+    self.y = torch.tensor(np.asarray(y), dtype=torch.float).to(dev)
+    self.w = torch.tensor(np.asarray(w), dtype=torch.float).to(dev)
+    self.cdf = None
+
+  def __len__(self):
+    return len(self.y)
+
+  def take(self, idx):
+    """(X, y, w) of the rows given by a tensor of indices"""
+    if self.rows is None:
+      X = self.X.index_select(0, idx)
+    else:
+      X = self.X.index_select(0, self.rows.index_select(0, idx))
+      X[:, -self.n_params:] = self.combinations.index_select(0, self.mass_ids.index_select(0, idx))
+    return X, self.y.index_select(0, idx), self.w.index_select(0, idx)
+
+  def weightedSample(self, n):
+    """n indices drawn with replacement with probability proportional to abs(w), by inverting the cumulative distribution"""
+    if self.cdf is None:
+      cdf = torch.cumsum(self.w.abs().double(), 0)
+      self.cdf = cdf / cdf[-1]
+    u = torch.rand(n, dtype=torch.float64, device=self.cdf.device)
+    return torch.searchsorted(self.cdf, u, right=True).clamp_(max=len(self)-1)
+
 class Model:
   def __init__(self, hyperparams=None):
     self.initModel(hyperparams)
@@ -75,57 +144,46 @@ class ParamModel(Model):
     self.n_features = n_features
     self.initModel(hyperparams)
 
-  def equaliseWeights(self, X, y, w):
+  def equaliseWeights(self, X, y, w, mass_ids):
     #In ParamModel we first equalise weights among signal processes
-    
-    #find unique combinations of parameters (masses)
-    unique_combinations, counts = np.unique(X[y==1,-self.n_params:], axis=0, return_counts=True)
+    #mass_ids is the index of each row's combination of parameters (masses), see inflateBkgIndices
+    sig_mass_ids = mass_ids[y==1]
+    counts = np.bincount(sig_mass_ids)
+    sumw = np.bincount(sig_mass_ids, weights=w[y==1])
 
-    norm = counts[0] #arbitarily choose the number of events from first signal processes to norm to
+    norm = counts[counts>0][0] #arbitarily choose the number of events from first signal processes to norm to
     #norm = 1
 
-    for combination in unique_combinations:
-      signal_proc_selection = (X[:,-self.n_params:] == combination).all(axis=1) & y==1
-      w[signal_proc_selection] *= norm / w[signal_proc_selection].sum() #norm to sumw = 1
+    scale = np.zeros(len(counts))
+    scale[counts>0] = norm / sumw[counts>0] #norm to sumw = 1
+    w[y==1] *= scale[sig_mass_ids]
     assert np.isclose(w[y==1].sum(), norm*self.n_sig_procs), print("Equalisation amongst signal processes failed. \nn_sig_procs = %d \nsig_sum_w = %f"%(self.n_sig_procs, w[y==1].sum()))
 
     return Model.equaliseWeights(self, X, y, w)
 
-  def shuffleBkg(self, X, y):
-    """Randomly assign values of possible parameters (masses) to the background"""
-    #find unique combinations of parameters (masses)
-    unique_combinations = np.unique(X[y==1,-self.n_params:], axis=0)
-
+  def shuffleBkg(self, X, y, unique_combinations):
+    """Randomly assign values of possible parameters (masses), e.g. from inflateBkgIndices, to the background"""
     choices = np.random.choice(np.arange(len(unique_combinations)), sum(y==0))
     X[y==0,-self.n_params:] = unique_combinations[choices]   
     return X
 
-  def inflateBkgWithMasses(self, X, y, w):
-    print("Bkg inflate 1", tracemalloc.get_traced_memory())
+  def inflateBkgIndices(self, X, y):
+    """
+    Virtual version of inflateBkgWithMasses. Returns (rows, mass_ids, unique_combinations) where row i
+    of the inflated dataset is X[rows[i]] with masses unique_combinations[mass_ids[i]] (see InflatedArray),
+    in the same order as the rows returned by inflateBkgWithMasses.
+    """
+    unique_combinations, sig_mass_ids = np.unique(X[y==1,-self.n_params:], axis=0, return_inverse=True)
+    bkg_rows = np.flatnonzero(y==0)
 
-    X_sig, y_sig, w_sig = X[y==1], y[y==1], w[y==1]
-    X_bkg, y_bkg, w_bkg = X[y==0], y[y==0], w[y==0]
-    print("Bkg inflate 2", tracemalloc.get_traced_memory())
-    
-    #lists to hold signal samples and copies of bkg before concatenating
-    Xs, ys, ws = [X_sig], [y_sig], [w_sig]
-    print("Bkg inflate 3", tracemalloc.get_traced_memory())  
-    
-    #find unique combinations of parameters (masses)
-    unique_combinations = np.unique(X[y==1,-self.n_params:], axis=0)
-    for combination in unique_combinations:
-      X_bkg_c, y_bkg_c, w_bkg_c = X_bkg.copy(), y_bkg.copy(), w_bkg.copy()
-      X_bkg_c[:, -self.n_params:] = combination
-      print("Bkg inflate 4", tracemalloc.get_traced_memory())
-      
-      Xs.append(X_bkg_c)
-      ys.append(y_bkg_c)
-      ws.append(w_bkg_c)
-      print("Bkg inflate 5", tracemalloc.get_traced_memory())
-
-    X, y, w = np.concatenate(Xs), np.concatenate(ys), np.concatenate(ws)
-    print("Bkg inflate 6", tracemalloc.get_traced_memory())
-    return X, y, w
+    rows = np.concatenate([np.flatnonzero(y==1), np.tile(bkg_rows, len(unique_combinations))])
+    mass_ids = np.concatenate([sig_mass_ids, np.repeat(np.arange(len(unique_combinations)), len(bkg_rows))])
+    return rows, mass_ids, unique_combinations
+
+  def inflateBkgWithMasses(self, X, y, w):
+    """Physical copy of the background for every combination of parameters (masses). Also returns the index of each row's combination."""
+    rows, mass_ids, unique_combinations = self.inflateBkgIndices(X, y)
+    return InflatedArray(X, rows, mass_ids, unique_combinations)[:], y[rows], w[rows], mass_ids
 
 class ParamBDT(ParamModel):
   def initModel(self, hyperparams=None):
@@ -139,20 +197,59 @@ class ParamBDT(ParamModel):
     self.model = xgb.XGBClassifier(**hyperparams)
 
   def fit(self, X, y, w):
-    #X = self.shuffleBkg(X, y)
-    X, y, w = self.inflateBkgWithMasses(X, y, w)
-    self.equaliseWeights(X, y, w)
+    #X = self.shuffleBkg(X, y, unique_combinations)
+    X, y, w, mass_ids = self.inflateBkgWithMasses(np.asarray(X), np.asarray(y), np.asarray(w))
+    self.equaliseWeights(X, y, w, mass_ids)
     print(">> Training sample summary")
     self.printNumAndWeight(y, w)
     self.model.fit(X, y, sample_weight=w)
 
   def predict_proba(self, X):
-    #find unique combinations of parameters (masses)
-    unique_combinations = np.unique(X[:,-self.n_params:], axis=0)
-    assert len(unique_combinations)==1, print("Expect only one combination of parameters (masses) when evaluating ParamBDT")
+    #cheap check that there is one combination of parameters (masses), np.unique would sort the whole input
+    if len(X) > 0:
+      assert (X[0,-self.n_params:] == X[-1,-self.n_params:]).all(), print("Expect only one combination of parameters (masses) when evaluating ParamBDT")
 
     return self.model.predict_proba(X)
 
+  def predictProbaMasses(self, X, masses, max_rows=2**22):
+    """
+    Signal probability of every event for every combination of masses, the same as predict_proba(X)[:,1]
+    with the mass columns of X set to each combination in turn.
+    The features are copied into a float32 block holding the events once per mass for as many masses as fit
+    in max_rows, and only the mass columns are rewritten for each chunk of masses, which is scored with
+    Booster.inplace_predict using the classifier's n_jobs threads (default: the cores available to this process).
+    X: (events, features) with the masses as the last n_params columns (their values are not used)
+    masses: (n_masses, n_params)
+    Returns an (events, n_masses) array.
+    """
+    masses = np.asarray(masses, dtype=np.float32)
+    n_events, n_features = X.shape
+    assert (masses.ndim == 2) and (masses.shape[1] == self.n_params), print("Expect masses of shape (n_masses, %d), got %s"%(self.n_params, masses.shape))
+    assert n_features > self.n_params, print("Expect the features followed by %d mass columns, got %d columns"%(self.n_params, n_features))
+    scores = np.zeros((n_events, len(masses)), dtype=np.float32)
+    if n_events == 0: return scores
+
+    #set the number of threads for this prediction only, the booster is pickled with the model
+    booster = self.model.get_booster()
+    old_nthread = json.loads(booster.save_config())["learner"]["generic_param"]["nthread"]
+    nthread = self.model.n_jobs if (self.model.n_jobs != None) and (self.model.n_jobs > 0) else len(os.sched_getaffinity(0))
+    booster.set_param({"nthread": nthread})
+
+    try:
+      chunk_size = max(1, max_rows // n_events) #masses per chunk
+      block = np.empty((min(chunk_size, len(masses)), n_events, n_features), dtype=np.float32)
+      block[:] = np.asarray(X, dtype=np.float32)[np.newaxis]
+      for start in range(0, len(masses), chunk_size):
+        chunk = masses[start:start+chunk_size]
+        chunk_block = block[:len(chunk)]
+        chunk_block[:, :, -self.n_params:] = chunk[:, np.newaxis, :] #each block of n_events rows holds one mass
+
+        prediction = booster.inplace_predict(chunk_block.reshape(-1, n_features))
+        scores[:, start:start+len(chunk)] = prediction.reshape(len(chunk), n_events).T
+    finally:
+      booster.set_param({"nthread": old_nthread})
+    return scores
+
 class ParamNN(ParamModel):
   def initModel(self, hyperparams=None):
     self.outdir = None
@@ -215,63 +312,51 @@ class ParamNN(ParamModel):
       if param.requires_grad:
           print(name, param.data)
 
-  def BCELoss(self, input, target, weight):
+  def BCELoss(self, input, target, weight, reduction="mean"):
     x, y, w = input, target, weight
     log = lambda x: torch.log(x*(1-1e-8) + 1e-8)
-    return torch.mean(-w * (y*log(x) + (1-y)*log(1-x)))
+    loss = -w * (y*log(x) + (1-y)*log(1-x))
+    return torch.mean(loss) if reduction == "mean" else loss
 
   def MSELoss(self, input, target, weight):
     return torch.mean(weight * (input - target) ** 2)
 
-  def getTotLoss(self, X, y, w, batch_size=None, s=None):
-    losses = []
-    for batch_X, batch_y, batch_w in self.getBatches(X, y, w, batch_size):
-      loss = self.BCELoss(self.model(batch_X), batch_y, batch_w)
-      losses.append(loss.item())
-    return sum(losses)
-
-    # if s==None:
-    #   X_torch = torch.tensor(X, dtype=torch.float).reshape(-1, X.shape[1]).to(dev)
-    #   y_torch = torch.tensor(y, dtype=torch.float).to(dev)
-    #   w_torch = torch.tensor(w, dtype=torch.float).to(dev)
-    # else:
-    #   X_torch = torch.tensor(X[s], dtype=torch.float).reshape(-1, X.shape[1]).to(dev)
-    #   y_torch = torch.tensor(y[s], dtype=torch.float).to(dev)
-    #   w_torch = torch.tensor(w[s], dtype=torch.float).to(dev)
-    # return self.BCELoss(self.model(X_torch), y_torch, w_torch)
+  def getLossPerMass(self, data, batch_size=65536):
+    """Summed loss of the rows of each combination of masses in a StagedDataset, from one forward pass reduced with scatter_add"""
+    if data.mass_ids is None:
+      raise ValueError("getLossPerMass needs a StagedDataset made from an InflatedArray, which has the mass index of each row")
+    losses = torch.zeros(len(self.unique_combinations), dtype=torch.float64, device=data.y.device)
+    ids = torch.arange(len(data), device=data.y.device)
+    for i_picture in range(0, len(data), batch_size):
+      batch_ids = ids[i_picture:i_picture + batch_size]
+      batch_X, batch_y, batch_w = data.take(batch_ids)
+      loss = self.BCELoss(self.model(batch_X), batch_y, batch_w, reduction="none")
+      losses.scatter_add_(0, data.mass_ids.index_select(0, batch_ids), loss.double())
+    return losses.cpu().numpy()
+
+  def getBatches(self, X, y=None, w=None, batch_size=None, shuffle=False, weighted=False, epoch_size=None):
+    """
+    Yield (X, y, w) batches of tensors. X can be a StagedDataset (y and w are then not needed) which
+    is reused between epochs so that the arrays are only converted to tensors once.
+    """
+    data = X if isinstance(X, StagedDataset) else StagedDataset(X, y, w)
+    epoch_size = len(data) if epoch_size==None else int(epoch_size)
+    if batch_size==None: batch_size = len(data)
 
-  def getBatches(self, X, y, w, batch_size=None, shuffle=False, weighted=False, epoch_size=None):
-    if epoch_size==None: epoch_size = len(X)
-    if batch_size==None: batch_size = len(X)
+    if (not weighted) and (epoch_size > len(data)):
+      raise ValueError("Cannot draw %d rows without replacement from %d rows"%(epoch_size, len(data)))
 
     if shuffle and not weighted:
-      shuffle_ids = np.random.choice(len(X), epoch_size, replace=False)
-      X_sh = X[shuffle_ids].copy()
-      y_sh = y[shuffle_ids].copy()
-      w_sh = w[shuffle_ids].copy()
+      ids = torch.randperm(len(data), device=data.y.device)[:epoch_size]
     elif weighted:
-      if (not hasattr(self, "normed_weights")) or (len(w) != len(self.normed_weights)): self.normed_weights = abs(w)/sum(abs(w))
-      weighted_ids = np.random.choice(len(X), epoch_size, replace=True, p=self.normed_weights)
-      X_sh = X[weighted_ids].copy()
-      y_sh = y[weighted_ids].copy()
-      w_sh = w[weighted_ids].copy()
-      w_sh[w_sh>0] = 1
-      w_sh[w_sh<0] = -1
+      ids = data.weightedSample(epoch_size)
     else:
-      X_sh = X.copy()
-      y_sh = y.copy()
-      w_sh = w.copy()  
+      ids = torch.arange(epoch_size, device=data.y.device)
     
     for i_picture in range(0, epoch_size, batch_size):
-      batch_X = X_sh[i_picture:i_picture + batch_size]
-      batch_y = y_sh[i_picture:i_picture + batch_size]
-      batch_w = w_sh[i_picture:i_picture + batch_size]
-    
-      X_torch = torch.tensor(batch_X, dtype=torch.float).reshape(-1, X.shape[1]).to(dev)
-      y_torch = torch.tensor(batch_y, dtype=torch.float).to(dev)
-      w_torch = torch.tensor(batch_w, dtype=torch.float).to(dev)
-
-      yield X_torch, y_torch, w_torch
+      batch_X, batch_y, batch_w = data.take(ids[i_picture:i_picture + batch_size])
+      if weighted: batch_w = torch.sign(batch_w) #weights are already used in the sampling
+      yield batch_X, batch_y, batch_w
 
   def shouldEarlyStop(self):
     """
@@ -393,17 +478,19 @@ class ParamNN(ParamModel):
     self.model = torch.load("%s/%s.pt"%(self.outdir, self.model_save_name))
 
   def fit(self, X, y, w):
-    X, y, w = self.inflateBkgWithMasses(X, y, w)
-
-    self.unique_combinations = np.unique(X[:,-self.n_params:], axis=0) #unique combinations of masses (MX and MY)
+    #the background is inflated virtually: X is stored once and the masses are attached when rows are taken
+    X, y, w = np.asarray(X), np.asarray(y), np.asarray(w)
+    rows, mass_ids, self.unique_combinations = self.inflateBkgIndices(X, y) #unique combinations of masses (MX and MY)
     
-    #split samples into training and validation
-    Xt, Xv, yt, yv, wt, wv = train_test_split(X, y, w, test_size=0.2, random_state=1)
-    assert len(np.unique(Xt[:,-self.n_params:], axis=0)) == len(self.unique_combinations)
-    assert len(np.unique(Xv[:,-self.n_params:], axis=0)) == len(self.unique_combinations)
-
-    self.equaliseWeights(Xt, yt, wt)
-    self.equaliseWeights(Xv, yv, wv)
+    #split samples into training and validation, splitting the indices gives the same split as splitting a physical copy
+    it, iv = train_test_split(np.arange(len(rows)), test_size=0.2, random_state=1)
+    Xt, mt, yt, wt = InflatedArray(X, rows[it], mass_ids[it], self.unique_combinations), mass_ids[it], y[rows[it]], w[rows[it]]
+    Xv, mv, yv, wv = InflatedArray(X, rows[iv], mass_ids[iv], self.unique_combinations), mass_ids[iv], y[rows[iv]], w[rows[iv]]
+    assert (np.bincount(mt, minlength=len(self.unique_combinations)) > 0).all()
+    assert (np.bincount(mv, minlength=len(self.unique_combinations)) > 0).all()
+
+    self.equaliseWeights(Xt, yt, wt, mt)
+    self.equaliseWeights(Xv, yv, wv, mv)
     wv *= sum(wt) / sum(wv) #adjust weight of validation to allow comparison of losses
     
     print("Minimum weight in training set: ", min(abs(wt[yt==0])))
@@ -424,18 +511,14 @@ class ParamNN(ParamModel):
     print(">> Calculating epoch size")
     epoch_size = min([int(sum(yt==0)/len(self.unique_combinations)), sum(yt==1)])*2 #epoch size is 2*nbkg or 2*nsig, whatever is smallest
 
-    #find indicies for each mass, useful for calculating loss later
-    print(">> Finding mass indicies")
-    t_idx = []
-    v_idx = []
-    for mass in self.unique_combinations:
-      t_idx.append((Xt[:,-self.n_params:]==mass).sum(axis=1) == self.n_params)
-      v_idx.append((Xv[:,-self.n_params:]==mass).sum(axis=1) == self.n_params)
+    print(">> Staging training and validation sets")
+    train_data = StagedDataset(Xt, yt, wt)
+    validation_data = StagedDataset(Xv, yv, wv, base=train_data.X) #Xt and Xv are views of the same X
 
     with tqdm(range(self.hyperparams["max_epochs"])) as t:
       for i_epoch in t:
         self.model.train()
-        for batch_X, batch_y, batch_w in tqdm(self.getBatches(Xt, yt, wt, self.hyperparams["batch_size"], shuffle=True, weighted=True, epoch_size=epoch_size), leave=False):
+        for batch_X, batch_y, batch_w in tqdm(self.getBatches(train_data, batch_size=self.hyperparams["batch_size"], shuffle=True, weighted=True, epoch_size=epoch_size), leave=False):
           optimizer.zero_grad()
           loss = self.BCELoss(self.model(batch_X), batch_y, batch_w)
           loss.backward()
@@ -443,22 +526,12 @@ class ParamNN(ParamModel):
         
         self.model.eval()
         with torch.no_grad():
-          tl = []
-          vl = []
-
           #calculate loss over different masses
-          for i, mass in enumerate(self.unique_combinations):
-            s = t_idx[i]
-            tl.append(self.getTotLoss(Xt[s], yt[s], wt[s]) * len(Xt[s]))
-            s = v_idx[i]
-            vl.append(self.getTotLoss(Xv[s], yv[s], wv[s]) * len(Xv[s]))
-            # s = t_idx[i]
-            # tl.append(self.getTotLoss(Xt, yt, wt, s) * len(Xt[s]))
-            # s = v_idx[i]
-            # vl.append(self.getTotLoss(Xv, yv, wv, s) * len(Xv[s]))
+          tl = self.getLossPerMass(train_data)
+          vl = self.getLossPerMass(validation_data)
           
-          self.train_loss.append(np.array(tl))
-          self.validation_loss.append(np.array(vl))
+          self.train_loss.append(tl)
+          self.validation_loss.append(vl)
 
           t.set_postfix(train_loss=self.train_loss[-1].sum(), validation_loss=self.validation_loss[-1].sum(), gamma=scheduler.get_last_lr()[0])
           
@@ -484,6 +557,43 @@ class ParamNN(ParamModel):
 
     print("Finished training")
 
+  def splitAtMassLayer(self):
+    """
+    Split the network at the first Linear layer that the masses (the last n_params inputs) enter.
+    Returns (features, linear, rest) where features maps the feature columns to the non-mass inputs
+    of linear (the PassThroughLayer branch if there is one) and rest is the network after linear.
+    """
+    modules = list(self.model)
+    if isinstance(modules[0], cm.PassThroughLayer):
+      layer = modules[0]
+      return (lambda x: layer.ELU(layer.Dropout(layer.Linear(x)))), modules[1], torch.nn.Sequential(*modules[2:])
+    return (lambda x: x), modules[0], torch.nn.Sequential(*modules[1:])
+
+  def predictProbaMasses(self, X, masses, max_rows=2**20):
+    """
+    Signal probability of every event for every combination of masses, the same as predict_proba(X)[:,1]
+    with the mass columns of X set to each combination in turn. The feature part of the layer that the
+    masses enter is computed once per event and only the mass part, one vector per combination, is added per mass.
+    X: (events, features) with the masses as the last n_params columns (their values are not used)
+    masses: (n_masses, n_params)
+    Returns an (events, n_masses) array.
+    """
+    self.model.eval()
+    features, linear, rest = self.splitAtMassLayer()
+    masses = torch.tensor(np.asarray(masses, dtype=np.float32).reshape(-1, self.n_params)).to(dev)
+    batch_size = max(1, max_rows // len(masses)) #rows passed through the rest of the network at once
+
+    with torch.no_grad():
+      mass_part = masses @ linear.weight[:, -self.n_params:].T
+      scores = []
+      for i_picture in range(0, len(X), batch_size):
+        X_torch = torch.tensor(X[i_picture:i_picture + batch_size], dtype=torch.float).reshape(-1, X.shape[1]).to(dev)
+        feature_part = torch.nn.functional.linear(features(X_torch[:, :-self.n_params]), linear.weight[:, :-self.n_params], linear.bias)
+        h = (feature_part[:, np.newaxis, :] + mass_part[np.newaxis, :, :]).reshape(-1, feature_part.shape[1])
+        scores.append(rest(h).reshape(len(X_torch), len(masses)).to('cpu').numpy())
+    if len(scores) == 0: return np.zeros((0, len(masses)), dtype=np.float32)
+    return np.concatenate(scores)
+
   def predict_proba(self, X, batch_size=8192):
     self.model.eval()
     with torch.no_grad():
@@ -24,6 +24,7 @@ from plotting.training_plots import plotROC
 from plotting.training_plots import plotLoss
 
 import common
+import parquet_loader
 import models
 import preprocessing
 
@@ -41,11 +42,6 @@ def loadDataFrame(args, train_features):
   if not args.parquetSystematic: columns_to_load += common.weights_systematics
   columns_to_load = set(columns_to_load)
 
-  print(">> Loading dataframe")
-  df = pd.read_parquet(args.parquet_input, columns=columns_to_load)
-  if args.dataset_fraction != 1.0:
-    df = df.sample(frac=args.dataset_fraction)
-  df.rename({"weight_central": "weight"}, axis=1, inplace=True)
   with open(args.summary_input) as f:
     proc_dict = json.load(f)['sample_id_map']
 
@@ -57,10 +53,15 @@ def loadDataFrame(args, train_features):
   needed_ids = sig_ids+bkg_ids+data_ids
   
   reversed_proc_dict = {proc_dict[key]:key for key in proc_dict.keys()}
-  for i in df.process_id.unique():
+  for i in proc_dict.values():
     if i in needed_ids: print("> %s"%(reversed_proc_dict[i]).ljust(30), "kept")
     else: print("> %s"%(reversed_proc_dict[i]).ljust(30), "removed")
-  df = df[df.process_id.isin(needed_ids)] #drop uneeded processes
+
+  print(">> Loading dataframe")
+  df = parquet_loader.readDataFrame(args.parquet_input, columns=columns_to_load, process_ids=needed_ids, tier=args.dataset_tier) #only read needed processes
+  if args.dataset_fraction != 1.0:
+    df = df.sample(frac=args.dataset_fraction)
+  df.rename({"weight_central": "weight"}, axis=1, inplace=True)
 
   df["y"] = 0
   df.loc[df.process_id.isin(sig_ids), "y"] = 1
@@ -102,6 +103,25 @@ def cv_fold_consistent(args, train_df, test_df):
 
   return pd.concat(train_dfs), pd.concat(test_dfs)
 
+def predictProbaMasses(model, train_features, df, masses):
+  """
+  Signal probability (events x masses) of a model whose classifier has predictProbaMasses.
+  The features are transformed once and the masses are transformed through a dummy event per mass.
+  """
+  X = df[train_features]
+  if len(df) == 0: return np.zeros((0, len(masses)))
+
+  dummy_X = X.iloc[[0]*len(masses)].copy()
+  dummy_X.loc[:, "MX"] = [MX for MX, MY in masses]
+  dummy_X.loc[:, "MY"] = [MY for MX, MY in masses]
+  if "transformer" in model.named_steps:
+    X, dummy_X = model["transformer"].transform(X), model["transformer"].transform(dummy_X)
+  else:
+    X, dummy_X = X.to_numpy(), dummy_X.to_numpy()
+
+  classifier = model["classifier"]
+  return classifier.predictProbaMasses(X, dummy_X[:,-classifier.n_params:])
+
 def addScores(args, model, train_features, train_df, test_df, data, MX_to_eval=None):
   pd.options.mode.chained_assignment = None
 
@@ -114,14 +134,20 @@ def addScores(args, model, train_features, train_df, test_df, data, MX_to_eval=N
       MX, MY = common.get_MX_MY(sig_proc)
       MX_to_eval.append(MX)
 
-  for MX in MX_to_eval:
+  #score every mass at once if the classifier can
+  batched = hasattr(model["classifier"], "predictProbaMasses")
+  if batched:
+    scores = [predictProbaMasses(model, train_features, df, [(MX, 125) for MX in MX_to_eval]) for df in dfs]
+
+  for j, MX in enumerate(MX_to_eval):
     MY = 125
     sig_proc = "XToHHggTauTau_M%d"%MX
     print(sig_proc, MX, MY)
-    for df in dfs:
+    for i, df in enumerate(dfs):
       df.loc[:, "MX"] = MX
       df.loc[:, "MY"] = MY
-      df["score_%s"%sig_proc] = model.predict_proba(df[train_features])[:,1] + np.random.normal(scale=1e-8, size=len(df)) #little deviation helpful for transforming score later
+      score = scores[i][:,j] if batched else model.predict_proba(df[train_features])[:,1]
+      df["score_%s"%sig_proc] = score + np.random.normal(scale=1e-8, size=len(df)) #little deviation helpful for transforming score later
       df.loc[:, "score_%s"%sig_proc] = (df["score_%s"%sig_proc] - df["score_%s"%sig_proc].min()) #rescale so everything within 0 and 1
       df.loc[:, "score_%s"%sig_proc] = (df["score_%s"%sig_proc] / df["score_%s"%sig_proc].max())
 
@@ -550,6 +576,7 @@ if __name__=="__main__":
   parser.add_argument('--remove-gjets-everywhere', action="store_true")
   parser.add_argument('--remove-gjets-training', action="store_true")
   parser.add_argument('--dataset-fraction', type=float, default=1.0, help="Only use a fraction of the whole dataset.")
+  parser.add_argument('--dataset-tier', type=float, default=None, help="Read the stratified subsample tier with this fraction of events (see dataset_tiers.py) instead of the whole dataset.")
 
   parser.add_argument('--hyperparams',type=str, default=None)
   parser.add_argument('--hyperparams-grid', type=str, default=None)